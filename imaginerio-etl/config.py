@@ -9,11 +9,22 @@ ITEMS_TO_PROCESS = "data/input/items_to_process.xls"
 KMLS_IN = "data/input/kmls"
 KMLS_OUT = "data/output/kmls"
 GEOJSON = "data/output/viewcones.geojson"
+STATE_DB = "data/output/state.db"
+JOURNAL = "data/output/journal.db"
+METADATA_HASHES = "data/output/metadata_hashes.db"  # per value hashes of the last published export
+SHARDS_DIR = "data/output/shards"  # artifacts of sharded runs, merged by scripts.finalize
+WORKSPACE = os.getenv("WORKSPACE", ".")  # root of local iiif/ trees, e.g. a tmpfs like /dev/shm
+WORKSPACE_BUDGET = int(os.getenv("WORKSPACE_BUDGET") or 0)  # bytes of local trees, 0 = unlimited
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+COLLECTIONS_CACHE = os.path.join(CACHE_DIR, "collections")
+S3_INDEX = os.path.join(CACHE_DIR, "s3index.db")
+S3_INDEX_MAX_AGE = int(os.getenv("S3_INDEX_MAX_AGE") or 24 * 3600)  # seconds before resweeping
 
 # URLs and endpoints
 CLOUDFRONT = "https://iiif.imaginerio.org/iiif"
 BUCKET = "https://imaginerio-images.s3.us-east-1.amazonaws.com/"
 BUCKET_NAME = "imaginerio-images"
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # e.g. a local S3 stand-in for benchmarks
 
 # Environment variables
 DISTRIBUTION_ID = os.getenv("DISTRIBUTION_ID")
@@ -22,8 +33,39 @@ ARCGIS_PASSWORD = os.getenv("ARCGIS_PASSWORD")
 ARCGIS_PORTAL = os.getenv("ARCGIS_PORTAL")
 VIEWCONES_LAYER_URL = os.getenv("VIEWCONES_LAYER_URL")
 RETILE = os.getenv("RETILE", False)
+RESUME = os.getenv("RESUME", False)
+BUDGET = float(os.getenv("BUDGET") or 0)  # minutes a run may take, 0 = no limit
+BUDGET_MARGIN = 5 * 60  # seconds kept to upload collections and wrap up
+INVALIDATE = os.getenv("INVALIDATE", "dry-run")  # CloudFront invalidation: submit, dry-run or off
 REPROCESS = os.getenv("REPROCESS", False)
 
+# Parallelism
+WORKERS = int(os.getenv("WORKERS") or 1)  # tiling processes, 1 = serial
+UPLOAD_THREADS = int(os.getenv("UPLOAD_THREADS") or 16)  # concurrent S3 uploads
+FETCH_THREADS = int(os.getenv("FETCH_THREADS") or 16)  # concurrent info.json/S3 reads
+DOWNLOAD_THREADS = int(os.getenv("DOWNLOAD_THREADS") or 4)  # items downloading at once
+UPLOAD_ITEMS = int(os.getenv("UPLOAD_ITEMS") or 2)  # items uploading at once, UPLOAD_THREADS each
+QUEUE_SIZE = int(os.getenv("QUEUE_SIZE") or 2)  # items waiting between pipeline stages
+FLUSH_EVERY = int(os.getenv("FLUSH_EVERY") or 100)  # items between collection uploads
+
+# Files from this size on, i.e. full-resolution images, get parallel multipart uploads
+MULTIPART_THRESHOLD = int(os.getenv("MULTIPART_THRESHOLD") or 32 * 1024**2)  # bytes
+MULTIPART_CHUNK_SIZE = int(os.getenv("MULTIPART_CHUNK_SIZE") or 16 * 1024**2)  # bytes per part
+MULTIPART_THREADS = int(os.getenv("MULTIPART_THREADS") or 8)  # parts uploading at once
+
+# Source image downloads
+DOWNLOAD_CHUNK_SIZE = 1024**2  # bytes held in memory at a time
+DOWNLOAD_ATTEMPTS = 3  # an interrupted download resumes where it stopped
+DOWNLOAD_CACHE = os.path.join(CACHE_DIR, "images")
+# Bytes of source images kept between runs, 0 disables. Only worth enabling where
+# CACHE_DIR persists, cached images count on top of WORKSPACE_BUDGET.
+DOWNLOAD_CACHE_SIZE = int(os.getenv("DOWNLOAD_CACHE_SIZE") or 0)
+
+# Tiling backend: "subprocess" runs the vips CLI, "pyvips" tiles in-process
+TILER = os.getenv("TILER", "subprocess")
+VIPS_CONCURRENCY = int(os.getenv("VIPS_CONCURRENCY") or 0)  # libvips threads, 0 = default
+VIPS_MAX_MEM = int(os.getenv("VIPS_MAX_MEM") or 100 * 1024**2)  # libvips operation cache, bytes
+
 # Metadata field names
 class MetadataFields:
     TITLE = "Title"
@@ -72,6 +114,8 @@ class IIIFConfig:
     LOGO_WIDTH = 708
     DEFAULT_RIGHTS = "http://rightsstatements.org/vocab/CNE/1.0/"
     IMAGE_SERVICE_PROFILE = "level0"
+    TILE_SIZE = 256
+    DERIVATIVE_FACTORS = [16, 8, 4, 2, 1]
     IMAGE_FORMAT = "image/jpeg"
     TEXT_FORMAT = "text/html"
 
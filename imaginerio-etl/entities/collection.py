@@ -0,0 +1,88 @@
+from collections.abc import Mapping
+
+from iiif_prezi3 import Collection
+
+
+class IndexedCollection:
+    """IIIF collection whose members are indexed by manifest id.
+
+    Adding, replacing and removing a member are O(1), where rebuilding
+    Collection.items for every item made updating a large collection
+    quadratic. Members keep their insertion order, and a replaced member keeps
+    its position. The collection is marked dirty when its members change, so
+    unchanged collections don't need to be uploaded again.
+    """
+
+    def __init__(self, collection: Collection):
+        self._collection = collection
+        self._items = {ref.id: ref for ref in collection.items or []}
+        self.dirty = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, manifest_id):
+        return manifest_id in self._items
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    @property
+    def id(self):
+        return self._collection.id
+
+    def add(self, manifest):
+        """Add a manifest by reference, replacing any member with the same id"""
+        self.add_reference(manifest.to_reference())
+
+    def add_reference(self, reference):
+        """Add a manifest reference, replacing any member with the same id"""
+        existing = self._items.get(reference.id)
+        if existing is None or existing.json() != reference.json():
+            self._items[reference.id] = reference
+            self.dirty = True
+
+    def remove(self, manifest_id):
+        """Remove a member if present"""
+        if self._items.pop(manifest_id, None) is not None:
+            self.dirty = True
+
+    def build(self) -> Collection:
+        """Return the underlying Collection with its items brought up to date"""
+        self._collection.items = list(self._items.values())
+        return self._collection
+
+    def json(self, **kwargs):
+        return self.build().json(**kwargs)
+
+
+class LazyCollections(Mapping):
+    """Collections by label, parsed into IndexedCollections on first access.
+
+    Args:
+        sources: Dictionary of label -> collection JSON as a dictionary, or
+            None for collections that aren't published yet
+        create: Callable returning a new Collection for a label
+    """
+
+    def __init__(self, sources, create):
+        self._sources = sources
+        self._create = create
+        self._loaded = {}
+
+    def __getitem__(self, label):
+        if label not in self._loaded:
+            source = self._sources[label]
+            collection = Collection(**source) if source else self._create(label)
+            self._loaded[label] = IndexedCollection(collection)
+        return self._loaded[label]
+
+    def __iter__(self):
+        return iter(self._sources)
+
+    def __len__(self):
+        return len(self._sources)
+
+    def loaded(self):
+        """Collections parsed so far, by label"""
+        return dict(self._loaded)
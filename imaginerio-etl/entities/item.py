@@ -1,30 +1,82 @@
+import hashlib
 import json
 import logging
 import os
 import subprocess
-from json import JSONDecodeError
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 import pandas as pd
+import requests
 
 from iiif_prezi3 import KeyValueString, Manifest, Canvas
 from PIL import Image
 
+try:
+    import pyvips
+except (ImportError, OSError):  # pyvips not installed or libvips missing
+    pyvips = None
+
 logging.getLogger("PIL").setLevel(logging.WARNING)
+logging.getLogger("pyvips").setLevel(logging.WARNING)
 
 from ..config import (
     CLOUDFRONT,
+    DOWNLOAD_ATTEMPTS,
+    DOWNLOAD_CACHE_SIZE,
+    DOWNLOAD_CHUNK_SIZE,
     RIGHTS,
+    TILER,
+    VIPS_CONCURRENCY,
+    VIPS_MAX_MEM,
+    WORKSPACE,
     MetadataFields as MF,
     VocabularyFields as VF,
     Languages as L,
     IIIFConfig as IC,
 )
-from ..utils.helpers import session, upload_folder_to_s3
+from ..utils.helpers import (
+    dump_json_atomic,
+    fetch_sizes,
+    session,
+    sync_folder_to_s3,
+    tree_objects,
+    upload_files_to_s3,
+    upload_folder_to_s3,
+)
+from ..utils.cache import DownloadCache
 from ..utils.logger import CustomFormatter as cf
 from ..utils.logger import logger
 
 Image.MAX_IMAGE_PIXELS = None
 
+download_cache = DownloadCache() if DOWNLOAD_CACHE_SIZE else None
+
+if pyvips:
+    pyvips.cache_set_max_mem(VIPS_MAX_MEM)
+    if VIPS_CONCURRENCY:
+        pyvips.concurrency_set(VIPS_CONCURRENCY)
+
+
+class TilingError(Exception):
+    """Raised when an image couldn't be tiled"""
+
+
+class NotModified(Exception):
+    """Raised when a conditional request finds the source image unchanged"""
+
+
+def _strong_validator(headers):
+    """The response's ETag, or its Last-Modified date, usable in If-Range.
+
+    Weak ETags can't be used in If-Range, so None is returned if that's all
+    there is.
+    """
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
 
 class Item:
     def __init__(self, id, row, vocabulary):
@@ -135,10 +187,14 @@ class Item:
         self._smapshot_id = row.get(MF.SMAPSHOT_ID)
         self._collection = row.get(MF.COLLECTION)
         self._jstor_img_path = row.get(MF.MEDIA_URL)
+        self._source_etag = None
+        self._source_last_modified = None
+        self._source_bytes = None
         self._base_path = f"{CLOUDFRONT}/{id}"
-        self._local_img_path = f"iiif/{id}/full/max/0/default.jpg"
+        self._local_dir = os.path.join(WORKSPACE, "iiif", id)
+        self._local_img_path = f"{self._local_dir}/full/max/0/default.jpg"
         self._img_path = f"{self._base_path}/full/max/0/default.jpg"
-        self._local_info_path = f"iiif/{id}/info.json"
+        self._local_info_path = f"{self._local_dir}/info.json"
         self._info_path = f"{self._base_path}/info.json"
         self._manifest_path = f"{self._base_path}/manifest.json"
 
@@ -150,11 +206,7 @@ class Item:
             return []
 
     def get_sizes(self):
-        try:
-            img_sizes = session.get(self._info_path).json()["sizes"]
-            return img_sizes
-        except JSONDecodeError:
-            return None
+        return fetch_sizes(self._info_path)
             
     def _format_dimension(self, value: Union[str, None]) -> Union[str, None]:
         """Convert dimension from millimeters to centimeters and format with unit.
@@ -180,21 +232,188 @@ class Item:
             )
             return str(value)
 
-    def download_image(self):
+    def download_image(
+        self,
+        chunk_size=DOWNLOAD_CHUNK_SIZE,
+        attempts=DOWNLOAD_ATTEMPTS,
+        cache=download_cache,
+        etag=None,
+        last_modified=None,
+    ):
+        """Stream the source image from JSTOR to disk.
+
+        Chunks are appended to a .part file that is renamed into place once its
+        size matches Content-Length, so memory use is bounded by chunk_size
+        whatever the image size. If the transfer is interrupted, the next
+        attempt resumes from the end of the .part file with a Range request.
+
+        The source's ETag and Last-Modified headers are kept for the next
+        run's conditional request. If it has one, the image is looked up in and
+        added to the download cache under it.
+
+        Args:
+            etag, last_modified: Validators from the last download. If given,
+                the source is requested conditionally and NotModified is raised
+                when it hasn't changed.
+
+        Returns:
+            SHA-256 hex digest of the downloaded image
+        """
+        os.makedirs(os.path.dirname(self._local_img_path), exist_ok=True)
+        if cache or etag or last_modified:
+            self._head_source(etag, last_modified)
+        validator = self._source_etag or self._source_last_modified
+        if cache and validator:
+            digest = cache.get(self._jstor_img_path, validator, self._local_img_path)
+            if digest:
+                self._source_bytes = os.path.getsize(self._local_img_path)
+                return digest
+
         logger.info(f"{cf.BLUE}Downloading image...{cf.RESET}")
-        response = session.get(self._jstor_img_path)
-        if response.status_code == 200:
-            os.makedirs(os.path.dirname(self._local_img_path), exist_ok=True)
-            with open(self._local_img_path, "wb") as handler:
-                handler.write(response.content)
-        else:
-            logger.error(
-                f"{cf.RED}Failed to download image {self._id} at {self._jstor_img_path}{cf.RESET}"
+        part_path = f"{self._local_img_path}.part"
+        start = time.perf_counter()
+        for attempt in range(1, attempts + 1):
+            try:
+                self._download_part(part_path, chunk_size)
+                break
+            except requests.HTTPError:
+                logger.error(
+                    f"{cf.RED}Failed to download image {self._id} at {self._jstor_img_path}{cf.RESET}"
+                )
+                raise
+            except IOError as e:  # includes connection errors and truncated transfers
+                if attempt == attempts:
+                    logger.error(
+                        f"{cf.RED}Failed to download image {self._id} at {self._jstor_img_path}{cf.RESET}"
+                    )
+                    raise
+                logger.warning(
+                    f"{cf.YELLOW}Download of item {self._id} interrupted ({e}), resuming{cf.RESET}"
+                )
+
+        if os.path.exists(f"{part_path}.validator"):
+            os.remove(f"{part_path}.validator")
+        digest = hashlib.sha256()
+        with open(part_path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        self._source_bytes = os.path.getsize(part_path)
+        os.replace(part_path, self._local_img_path)
+        logger.info(
+            f"{cf.BLUE}Downloaded {self._source_bytes / 1024**2:.1f} MB in "
+            f"{time.perf_counter() - start:.1f}s{cf.RESET}"
+        )
+        if cache and validator:
+            cache.put(
+                self._jstor_img_path, validator, self._local_img_path, digest.hexdigest()
+            )
+        return digest.hexdigest()
+
+    def _head_source(self, etag=None, last_modified=None):
+        """Read the source image's ETag and Last-Modified headers.
+
+        The request is conditional when validators from a previous download
+        are given. Failures are ignored, the image is then simply downloaded.
+
+        Raises:
+            NotModified: If the source hasn't changed since those validators
+        """
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        try:
+            response = session.head(
+                self._jstor_img_path, headers=headers, allow_redirects=True
+            )
+        except requests.RequestException:
+            return
+        if response.status_code == 304:
+            raise NotModified(f"Source image for item {self._id} not modified")
+        if response.ok:
+            self._source_etag = response.headers.get("ETag")
+            self._source_last_modified = response.headers.get("Last-Modified")
+
+    def _download_part(self, part_path, chunk_size):
+        """Download the source image into part_path, resuming from its current size.
+
+        The validator of the response that started the .part file is kept next
+        to it and sent as If-Range, so a source that changed since (e.g.
+        between runs) is downloaded again instead of being spliced onto the
+        old bytes. A .part file without a validator is discarded.
+        """
+        validator_path = f"{part_path}.validator"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        validator = None
+        if offset and os.path.exists(validator_path):
+            with open(validator_path, "r", encoding="utf-8") as f:
+                validator = f.read().strip()
+        headers = {"Range": f"bytes={offset}-", "If-Range": validator} if validator else {}
+        offset = offset if validator else 0
+        with session.get(self._jstor_img_path, headers=headers, stream=True) as response:
+            if response.status_code == 416:  # .part is already complete or stale
+                os.remove(part_path)
+                raise IOError(f"Range not satisfiable for item {self._id}")
+            if response.status_code not in (200, 206):
+                response.raise_for_status()
+                raise IOError(f"Unexpected status {response.status_code} for item {self._id}")
+            # Stored with the item's state for the next run's conditional request
+            self._source_etag = response.headers.get("ETag") or self._source_etag
+            self._source_last_modified = (
+                response.headers.get("Last-Modified") or self._source_last_modified
+            )
+            if response.status_code == 200:
+                # Range ignored, or the source changed since the .part was started
+                offset = 0
+                validator = _strong_validator(response.headers)
+                if validator:
+                    with open(validator_path, "w", encoding="utf-8") as f:
+                        f.write(validator)
+                elif os.path.exists(validator_path):
+                    os.remove(validator_path)
+            content_length = response.headers.get("Content-Length")
+            with open(part_path, "ab" if offset else "wb") as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+        if content_length and not response.headers.get("Content-Encoding"):
+            expected = offset + int(content_length)
+            size = os.path.getsize(part_path)
+            if size != expected:
+                raise IOError(
+                    f"Incomplete download for item {self._id}: {size} of {expected} bytes"
+                )
+
+    def tile_image(self, testing=False, backend=TILER, download=True, upload=True):
+        """Download and tile the item's image, create derivatives and upload them.
+
+        Args:
+            testing: Skip the upload to S3
+            backend: "pyvips" to tile in-process, anything else runs the vips CLI
+            download: Set to False if download_image was already called
+            upload: Set to False to call upload_tiles separately
+
+        Returns:
+            List of image sizes, smallest first
+        """
+        if download:
+            self.download_image()
+        logger.info(f"{cf.BLUE}Tiling image...")
+        if backend == "pyvips" and not pyvips:
+            logger.warning(
+                f"{cf.YELLOW}pyvips is unavailable, falling back to the vips CLI{cf.RESET}"
             )
-            raise Exception(IOError)
+            backend = "subprocess"
+        if backend == "pyvips":
+            sizes = self._tile_pyvips(IC.DERIVATIVE_FACTORS)
+        else:
+            self._tile_subprocess()
+            sizes = self.create_derivatives(IC.DERIVATIVE_FACTORS)
+        if upload and not testing:
+            self.upload_tiles()
+        return sizes
 
-    def tile_image(self, testing=False):
-        self.download_image()
+    def _tile_subprocess(self):
         command = [
             "vips",
             "dzsave",
@@ -203,44 +422,144 @@ class Item:
             "--id",
             CLOUDFRONT,
             "--tile-size",
-            "256",
+            str(IC.TILE_SIZE),
             self._local_img_path,
-            f"iiif/{self._id}",
+            self._local_dir,
         ]
-        logger.info(f"{cf.BLUE}Tiling image...")
-        subprocess.run(command)
-        sizes = self.create_derivatives([16, 8, 4, 2, 1])
-        if not testing:
-            upload_folder_to_s3(f"iiif/{self._id}")
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise TilingError(
+                f"vips dzsave failed for item {self._id}: {result.stderr.strip()}"
+            )
+
+    def _tile_pyvips(self, factors):
+        """Tile the image and create its derivatives from a single libvips decode.
+
+        Args:
+            factors: Downscaling factors, in the order sizes are listed in info.json
+
+        Returns:
+            List of {"width", "height"} dictionaries, one per factor
+        """
+        try:
+            image = pyvips.Image.new_from_file(self._local_img_path)
+            image.dzsave(
+                self._local_dir,
+                layout="iiif3",
+                id=CLOUDFRONT,
+                tile_size=IC.TILE_SIZE,
+            )
+            sizes = [
+                {"width": image.width // factor, "height": image.height // factor}
+                for factor in factors
+            ]
+            level = image
+            for factor in sorted(factor for factor in set(factors) if factor != 1):
+                width, height = image.width // factor, image.height // factor
+                level = level.thumbnail_image(width, height=height, size="force")
+                path = f"{self._local_dir}/full/{width},{height}/0"
+                os.makedirs(path, exist_ok=True)
+                level.jpegsave(f"{path}/default.jpg", Q=95)
+        except pyvips.Error as e:
+            raise TilingError(f"pyvips failed to tile item {self._id}: {e}") from e
+        self._write_sizes(sizes)
         return sizes
-        # os.remove(os.path.abspath(self._local_img_path))
+
+    def upload_tiles(self, sync=False, delete_orphans=False):
+        """Upload the item's tile tree, retrying failed files once.
+
+        Args:
+            sync: Only upload files missing or different in S3
+            delete_orphans: When syncing, also delete remote files the local
+                tree doesn't have, except the manifest
+
+        Returns:
+            Dictionary of upload statistics, see sync_folder_to_s3, with
+            objects, the (key, size, etag) of every file of the tree for the
+            S3 index, and orphans, the keys deleted
+        """
+        if sync:
+            stats = sync_folder_to_s3(
+                self._local_dir,
+                root=WORKSPACE,
+                delete=delete_orphans,
+                exclude={f"iiif/{self._id}/manifest.json"},
+            )
+        else:
+            results = upload_folder_to_s3(self._local_dir, root=WORKSPACE)
+            stats = {
+                "uploaded": sum(results.values()),
+                "failed": [path for path, ok in results.items() if not ok],
+                "orphans": [],
+            }
+        failed = stats.pop("failed")
+        if failed:
+            logger.warning(
+                f"{cf.YELLOW}Retrying {len(failed)} failed uploads for item {self._id}{cf.RESET}"
+            )
+            results = upload_files_to_s3(failed, root=WORKSPACE)
+            stats["uploaded"] += sum(results.values())
+            failed = [path for path, ok in results.items() if not ok]
+        if failed:
+            raise IOError(f"Failed to upload {len(failed)} files for item {self._id}")
+        stats["objects"] = tree_objects(self._local_dir, root=WORKSPACE)
+        return stats
 
     def create_derivatives(self, factors):
+        """Create downscaled copies of the full image and record all sizes in info.json.
+
+        The full image is decoded once, at the smallest JPEG draft scale that
+        still covers the largest derivative. Each smaller level is resized from
+        the previous one and encoded concurrently with the next resize.
+
+        Args:
+            factors: Downscaling factors, in the order sizes are listed in info.json
+
+        Returns:
+            List of {"width", "height"} dictionaries, one per factor
+        """
         logger.info(f"{cf.BLUE}Creating derivatives...")
-        sizes = []
-        for factor in factors:
-            with Image.open(self._local_img_path) as im:
-                full_width, full_height = im.size
-                width, height = full_width // factor, full_height // factor
-                sizes.append({"width": width, "height": height})
-                if factor != 1:
-                    path = f"iiif/{self._id}/full/{width},{height}/0"
-                    os.makedirs(path, exist_ok=True)
-                    im.resize((width, height)).save(
-                        f"{path}/default.jpg",
-                        quality=95,
-                        icc_profile=im.info.get("icc_profile"),
-                    )
-                # else:
-                #     path = f"iiif/{self._id}/full/max/0"
-            with open(self._local_info_path, "r+") as f:
-                info = json.load(f)
-                info["sizes"] = sizes
-                f.seek(0)  # rewind
-                json.dump(info, f, indent=4)
-                f.truncate()
+        with Image.open(self._local_img_path) as im:
+            full_width, full_height = im.size
+            icc_profile = im.info.get("icc_profile")
+            sizes = [
+                {"width": full_width // factor, "height": full_height // factor}
+                for factor in factors
+            ]
+            reductions = sorted(factor for factor in set(factors) if factor != 1)
+            if reductions:
+                im.draft(
+                    im.mode,
+                    (full_width // reductions[0], full_height // reductions[0]),
+                )
+                level = im
+                with ThreadPoolExecutor(max_workers=len(reductions)) as executor:
+                    futures = []
+                    for factor in reductions:
+                        width, height = full_width // factor, full_height // factor
+                        level = level.resize((width, height))
+                        futures.append(
+                            executor.submit(
+                                self._save_derivative, level, width, height, icc_profile
+                            )
+                        )
+                    for future in futures:
+                        future.result()
+
+        self._write_sizes(sizes)
         return sizes
 
+    def _write_sizes(self, sizes):
+        with open(self._local_info_path, "r") as f:
+            info = json.load(f)
+        info["sizes"] = sizes
+        dump_json_atomic(info, self._local_info_path, indent=4)
+
+    def _save_derivative(self, im, width, height, icc_profile):
+        path = f"{self._local_dir}/full/{width},{height}/0"
+        os.makedirs(path, exist_ok=True)
+        im.save(f"{path}/default.jpg", quality=95, icc_profile=icc_profile)
+
     def _format_wikidata_term(self, value_en: str) -> Union[tuple[str, str], None]:
         """
         Processes a single English term, looking up Wikidata info and translation.
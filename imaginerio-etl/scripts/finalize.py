@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+
+from iiif_prezi3 import ManifestRef
+
+from ..config import INVALIDATE, SHARDS_DIR
+from ..utils.helpers import load_collections, summarize
+from ..utils.invalidation import Invalidations
+from ..utils.logger import CustomFormatter as cf
+from ..utils.logger import logger
+from ..utils.shard import load_shards, merge_summaries
+from ..utils.state import StateStore
+from .iiif import flush_collections
+
+
+def finalize(directory=SHARDS_DIR, count=None, invalidations=None, store=None):
+    """Merge the artifacts of a sharded run and publish its collections once.
+
+    Every collection a shard changed is fetched, updated with the references
+    of all shards and uploaded a single time. Shard item states are written
+    to store and their CloudFront paths added to invalidations. Artifacts are
+    removed once everything is published, and kept for a retry otherwise.
+
+    Args:
+        count: Number of shards of the run, read from the artifacts if None
+
+    Returns:
+        The merged summary of the shards, or None if a collection upload failed
+    """
+    artifacts = load_shards(directory, count)
+    labels = sorted({label for artifact in artifacts for label in artifact.collections})
+    logger.info(
+        f"Merging {cf.GREEN}{len(artifacts)}{cf.RESET} shards changing "
+        f"{cf.GREEN}{len(labels)}{cf.RESET} collections"
+    )
+    collections = load_collections(labels)
+    for artifact in artifacts:
+        for label, changes in artifact.collections.items():
+            for reference in changes.references.values():
+                collections[label].add_reference(ManifestRef(**json.loads(reference)))
+            for manifest_id in changes.removed:
+                collections[label].remove(manifest_id)
+        if invalidations is not None:
+            for path in artifact.invalidations:
+                invalidations.add(path)
+        if store is not None:
+            for id, fields in artifact.states.items():
+                store.update(id, commit=False, **fields)
+    if store is not None:
+        store.commit()
+
+    if not flush_collections(collections, invalidations):
+        logger.error(
+            f"{cf.RED}Some collections failed to upload, shard artifacts were kept "
+            f"in {directory}, run finalize again to retry"
+        )
+        return None
+    for artifact in artifacts:
+        os.remove(artifact.path)
+    return merge_summaries(artifact.summary for artifact in artifacts)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Publish the collections of a sharded update run."
+    )
+    parser.add_argument("--dir", default=SHARDS_DIR, help="Directory of shard artifacts")
+    parser.add_argument(
+        "--shards", type=int, help="Number of shards expected (default: from artifacts)"
+    )
+    parser.add_argument(
+        "--invalidate",
+        choices=["submit", "dry-run", "off"],
+        default=INVALIDATE,
+        help="Invalidate the CloudFront paths touched by every shard, "
+        "or only report them (default: dry-run)",
+    )
+    args = parser.parse_args()
+
+    invalidations = (
+        Invalidations(dry_run=args.invalidate == "dry-run")
+        if args.invalidate != "off"
+        else None
+    )
+    with StateStore() as store:
+        manifest_info = finalize(args.dir, args.shards, invalidations, store)
+    if manifest_info is None:
+        raise SystemExit(1)
+
+    if invalidations is not None:
+        invalidations.submit()
+    logger.info(summarize(None, manifest_info))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,59 +1,718 @@
 import os
 import json
-from ..config import VOCABULARY, RETILE
-from ..entities.item import Item
-from ..utils.helpers import get_collections, get_vocabulary, upload_object_to_s3
+import hashlib
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain
+
+import requests
+from iiif_prezi3 import ManifestRef
+
+from ..config import (
+    CLOUDFRONT,
+    DOWNLOAD_THREADS,
+    FETCH_THREADS,
+    FLUSH_EVERY,
+    QUEUE_SIZE,
+    RETILE,
+    UPLOAD_ITEMS,
+    VOCABULARY,
+    WORKERS,
+    MetadataFields as MF,
+)
+from ..entities.item import Item, NotModified
+from ..utils import helpers
+from ..utils.helpers import (
+    get_collections,
+    get_etag,
+    get_vocabulary,
+    peak_rss,
+    prefetch_sizes,
+    reset_peak_rss,
+    upload_object_to_s3,
+)
+from ..utils.jpeg import probe_image_size
 from ..utils.logger import CustomFormatter as cf
 from ..utils.logger import logger
+from ..utils.pipeline import Stage, run_pipeline
+from ..utils.s3index import S3Index
+from ..utils.schedule import InFlight, estimate_costs, order_by_cost, within_deadline
+from ..utils.state import COLUMNS, StateStore, hash_manifest
+from ..utils.workspace import Workspace
+
+_vocabulary = None
+
+# Columns whose changes need more than rebuilding the manifest
+TILE_FIELDS = {MF.MEDIA_URL}
+COLLECTION_FIELDS = {MF.COLLECTION}
+
+
+def _worker_context():
+    """Start tiling workers without forking this process.
+
+    Workers start once stage threads are running, and a fork could copy a
+    lock held by one of them (in urllib3, requests or botocore) and deadlock
+    the child.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _init_worker(vocabulary):
+    """Process pool initializer: receive the vocabulary once, reset inherited clients"""
+    global _vocabulary
+    _vocabulary = vocabulary
+    helpers.reset_clients()
+
+
+def manifest_id(id):
+    """Id of an item's manifest, as referenced by collections"""
+    return f"{CLOUDFRONT}/{id}/manifest.json"
+
+
+def split_labels(value):
+    """Collection labels of a Collection cell"""
+    return value.split("|") if isinstance(value, str) and value else []
+
+
+def route_changes(changes):
+    """Sort changed items by the work their changed columns require.
+
+    Args:
+        changes: Dictionary of id -> changed column -> previous value, see
+            metadata_hash.diff_hashes
+
+    Returns:
+        Tuple of sets of ids (retile, membership): items whose source image
+        changed, and items of which only collections changed. The others only
+        need their manifest rebuilt.
+    """
+    retile = {id for id, fields in changes.items() if TILE_FIELDS & set(fields)}
+    membership = {id for id, fields in changes.items() if set(fields) <= COLLECTION_FIELDS}
+    return retile, membership
+
+
+def needs_tiling(state, testing=False):
+    """Whether an item must be (re)tiled given its resolved state"""
+    return (
+        not state.get("sizes")
+        or state.get("stale")
+        or testing
+        or RETILE == "true" # github action input, not boolean
+    )
+
+
+def fetch_source(item, state, testing=False, force=False):
+    """Resolve an item's image sizes, downloading its source image if needed.
+
+    Sizes come from the item's resolved state if present, otherwise from its
+    published info.json. When a retile is requested for an item that already
+    has tiles, the source image is requested conditionally, and tiling and
+    uploading are skipped if it wasn't modified. If it was downloaded, they
+    are still skipped when its hash matches the stored one. force disables
+    both checks.
+
+    Returns:
+        Dictionary with the item's sizes, the source_* fields of its state
+        (from the stored state if the image wasn't downloaded), not_modified,
+        and tile, whether the downloaded image must be tiled
+    """
+    if "sizes" not in state:
+        state["sizes"] = item.get_sizes()
+    result = {
+        "sizes": state["sizes"],
+        "source_hash": state.get("source_hash"),
+        "not_modified": False,
+        "tile": False,
+    }
+    if needs_tiling(state, testing):
+        reuse = bool(state["sizes"]) and not (force or testing or state.get("stale"))
+        try:
+            downloaded_hash = item.download_image(
+                etag=state.get("source_etag") if reuse else None,
+                last_modified=state.get("source_last_modified") if reuse else None,
+            )
+        except NotModified:
+            logger.info(f"{cf.BLUE}Source image for item {item._id} not modified, skipping tiling")
+            result["not_modified"] = True
+        else:
+            if reuse and downloaded_hash == state.get("source_hash"):
+                logger.info(f"{cf.BLUE}Source image for item {item._id} unchanged, skipping tiling")
+            else:
+                result["tile"] = True
+            result.update(
+                source_hash=downloaded_hash,
+                source_etag=item._source_etag,
+                source_last_modified=item._source_last_modified,
+                source_bytes=item._source_bytes,
+            )
+    return result
+
+
+def tile_item(id, row, vocabulary=None, isolated=True):
+    """Tile an item's downloaded source image, leaving the upload to the caller.
+
+    Runs in the parent or in a pool worker, so it must not touch collections
+    or any other state shared across items.
+
+    Args:
+        isolated: Whether nothing else runs in this process meanwhile, as in a
+            pool worker. Peak memory is only measured per item then.
+
+    Returns:
+        Tuple of (sizes, peak_rss), the peak resident memory in bytes while
+        tiling, or None if it wasn't measured
+    """
+    if isolated:
+        reset_peak_rss()
+    item = Item(id, row, vocabulary if vocabulary is not None else _vocabulary)
+    sizes = item.tile_image(download=False, upload=False)
+    if not isolated:
+        return sizes, None
+    logger.debug(f"Item {id} peak memory: {peak_rss() / 1024**2:.0f} MB")
+    return sizes, peak_rss()
+
+
+def process_item(id, row, vocabulary=None, testing=False, force=False, state=None):
+    """Run an item through every stage in the calling thread.
+
+    Returns:
+        Dictionary as returned by fetch_source, without tile, with peak_rss
+    """
+    reset_peak_rss()
+    item = Item(id, row, vocabulary if vocabulary is not None else _vocabulary)
+    result = fetch_source(item, dict(state or {}), testing, force)
+    if result.pop("tile"):
+        result["sizes"] = item.tile_image(download=False)
+    result["peak_rss"] = peak_rss()
+    return result
+
+
+def resolve_states(ids, store, stale=()):
+    """Look up the state of every item, prefetching unknown sizes concurrently.
+
+    Sizes missing from the store are fetched from the published info.json
+    files in one concurrent batch, before any item is processed.
+
+    Args:
+        stale: Ids of items whose tiles are known to be outdated
+
+    Returns:
+        Dictionary of item id -> state. A state only has a "sizes" key when
+        sizes are known, None meaning the item has never been tiled.
+    """
+    states = {}
+    for id in ids:
+        state = store.get(id) or {}
+        if not state.get("sizes"):
+            state.pop("sizes", None)
+        if id in stale:
+            state["stale"] = True
+        states[id] = state
+    missing = [id for id, state in states.items() if "sizes" not in state]
+    if missing:
+        logger.info(f"Prefetching sizes for {cf.GREEN}{len(missing)}{cf.RESET} items")
+        for id, sizes in prefetch_sizes(missing).items():
+            states[id]["sizes"] = sizes
+    return states
+
 
+def find_stale_items(metadata, store, threads=FETCH_THREADS):
+    """Find tiled items whose source image dimensions no longer match their tiles.
 
-def update(metadata, testing=False):
+    Only the header of each source image is fetched, with a Range request, so
+    the whole catalog can be checked without downloading any image.
+
+    Returns:
+        List of ids of items that need to be retiled
+    """
+    states = resolve_states(metadata.index, store)
+    urls = {
+        id: metadata.at[id, "Media URL"]
+        for id, state in states.items()
+        if state.get("sizes") and isinstance(metadata.at[id, "Media URL"], str)
+    }
+    logger.info(f"Probing source image dimensions of {cf.GREEN}{len(urls)}{cf.RESET} items")
+    stale = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(probe_image_size, url): id for id, url in urls.items()}
+        for future, id in futures.items():
+            try:
+                width, height = future.result()
+            except (requests.RequestException, ValueError) as e:
+                logger.warning(f"{cf.YELLOW}Couldn't probe item {id}: {e}{cf.RESET}")
+                continue
+            full = states[id]["sizes"][-1]
+            if (width, height) != (full["width"], full["height"]):
+                logger.info(
+                    f"Item {id} is {width}x{height} but was tiled at "
+                    f"{full['width']}x{full['height']}"
+                )
+                stale.append(id)
+    logger.info(f"{cf.GREEN}{len(stale)}{cf.RESET} items need to be retiled")
+    return stale
+
+
+def _process_serial(rows, vocabulary, testing, force, states):
+    for id, row in rows.iterrows():
+        try:
+            result = process_item(id, row, vocabulary, testing, force, states[id])
+            yield id, row, result, None
+        except Exception as e:
+            yield id, row, None, e
+
+
+def _process_pipeline(
+    rows,
+    vocabulary,
+    force,
+    states,
+    workers,
+    download_threads=DOWNLOAD_THREADS,
+    upload_items=UPLOAD_ITEMS,
+    queue_size=QUEUE_SIZE,
+    workspace=None,
+    sync=False,
+    delete_orphans=False,
+    costs=None,
+    deadline=None,
+    deferred=None,
+):
+    """Download, tile and upload items in overlapping stages.
+
+    Each stage has its own concurrency, so images are downloaded and uploaded
+    while others are tiled. The bounded queues between stages cap how many
+    images and tile trees sit on disk: a slow S3 stalls tiling, which stalls
+    downloads. Tiling also waits for the workspace's disk budget, and trees
+    are removed once uploaded. With more than one worker, tiling runs in a
+    process pool, otherwise in a single thread. With sync, only tiles that
+    differ from the published ones are uploaded.
+
+    Items are fed in the order of rows while they can be expected to finish
+    before deadline, after the items in flight, whose estimated costs are
+    shared by the workers. The ids of the others are appended to deferred. The
+    time spent on each tiled item is returned as tile_seconds.
+
+    Yields:
+        Tuples of (id, row, result, exception or None) as items complete
+    """
+    workspace = workspace or Workspace()
+    executor = (
+        ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=_worker_context(),
+            initializer=_init_worker,
+            initargs=(vocabulary,),
+        )
+        if workers > 1
+        else None
+    )
+
+    cancelled = threading.Event()
+
+    def download(job):
+        id, row, result = job
+        start = time.perf_counter()
+        item = Item(id, row, vocabulary)
+        try:
+            result = fetch_source(item, dict(states[id]), force=force)
+        except Exception:
+            workspace.release(id)  # the partial download, the item skips later stages
+            raise
+        if result["tile"]:
+            result["tile_seconds"] = time.perf_counter() - start
+        return id, row, result
+
+    def tile(job):
+        id, row, result = job
+        if not result["tile"]:
+            return job
+        try:
+            workspace.reserve(id, cancelled)
+            start = time.perf_counter()
+            if executor:
+                sizes, rss = executor.submit(tile_item, id, row).result()
+            else:
+                # Other stages share the process, the run's peak covers it
+                sizes, rss = tile_item(id, row, vocabulary, isolated=False)
+        except Exception:
+            workspace.release(id)
+            raise
+        workspace.measure(id)
+        result["sizes"] = sizes
+        if rss is not None:
+            result["peak_rss"] = rss
+        result["tile_seconds"] += time.perf_counter() - start
+        return job
+
+    def upload(job):
+        id, row, result = job
+        try:
+            if result.pop("tile"):
+                start = time.perf_counter()
+                result["upload"] = Item(id, row, vocabulary).upload_tiles(
+                    sync=sync, delete_orphans=delete_orphans
+                )
+                result["tile_seconds"] += time.perf_counter() - start
+        finally:
+            workspace.release(id)
+        return job
+
+    stages = [
+        Stage("download", download, download_threads),
+        Stage("tile", tile, workers),
+        Stage("upload", upload, upload_items),
+    ]
+    costs = costs if costs is not None else {id: 0 for id in rows.index}
+    deferred = deferred if deferred is not None else []
+    in_flight = InFlight(costs, workers)
+    jobs = (
+        (id, rows.loc[id], None)
+        for id in within_deadline(rows.index, costs, deadline, deferred, in_flight)
+    )
+    try:
+        for (id, row, result), error in run_pipeline(jobs, stages, queue_size, cancelled):
+            in_flight.finish(id)
+            yield id, row, None if error else result, error
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+
+def publish_manifest(id, manifest_json, stored_hash=None, index=None):
+    """Upload an item's manifest unless it's identical to the published one.
+
+    The manifest's canonical hash is compared with the one stored by the last
+    run. Without a stored hash, the MD5 of the serialized manifest is compared
+    with the ETag of the published object instead, read from the S3 index if
+    a fresh sweep covers it.
+
+    Returns:
+        Tuple of (published, manifest_hash). manifest_hash is None if the
+        upload failed.
+    """
+    key = f"iiif/{id}/manifest.json"
+    manifest_hash = hash_manifest(manifest_json)
+    body = manifest_json.encode("utf-8")
+    if stored_hash:
+        unchanged = stored_hash == manifest_hash
+    else:
+        if index is not None and index.is_fresh(key):
+            etag = index.etag(key)
+        else:
+            etag = get_etag(key)
+        unchanged = etag == hashlib.md5(body).hexdigest()
+    if unchanged:
+        logger.info(f"{cf.BLUE}Manifest for item {id} unchanged, skipping upload")
+        return False, manifest_hash
+    if upload_object_to_s3(manifest_json, id, key):
+        if index is not None:
+            index.record(key, len(body), hashlib.md5(body).hexdigest())
+        return True, manifest_hash
+    return False, None
+
+
+def flush_collections(collections, invalidations=None, journal=None):
+    """Upload the collections changed since they were last uploaded.
+
+    Returns:
+        True if every upload succeeded
+    """
+    flushed = []
+    for name, collection in collections.loaded().items():
+        if not collection.dirty:
+            logger.debug(f"Collection {name} unchanged, skipping upload")
+            continue
+        key = f"iiif/collection/{name.lower()}.json"
+        if upload_object_to_s3(collection.json(indent=4), name, key):
+            collection.dirty = False
+            flushed.append(name)
+            if invalidations is not None:
+                invalidations.add(key)
+    if journal is not None:
+        journal.flushed(flushed)
+    return all(not collection.dirty for collection in collections.loaded().values())
+
+
+def save_artifact(artifact, invalidations=None):
+    """Checkpoint a shard's artifact with the CloudFront paths touched so far"""
+    if invalidations is not None:
+        artifact.invalidations = invalidations.touched()
+    path = artifact.save()
+    logger.debug(f"Saved shard artifact to {path}")
+
+
+def update(
+    metadata,
+    testing=False,
+    workers=WORKERS,
+    force=False,
+    stale=(),
+    sync=False,
+    delete_orphans=False,
+    invalidations=None,
+    journal=None,
+    resume=False,
+    flush_every=FLUSH_EVERY,
+    deadline=None,
+    artifact=None,
+    changes=None,
+    removed=None,
+):
+    """Create and publish the manifests of items, tiling them as needed.
+
+    Collections are uploaded every flush_every items and at the end.
+
+    Args:
+        changes: Dictionary of id -> changed column -> previous value, routing
+            each item to the work its changes require (see route_changes).
+            Items that aren't in it are fully processed.
+        removed: Rows of items that aren't published anymore, removed from
+            their collections
+        invalidations: Invalidations collecting the CloudFront paths of
+            published manifests, retiled items and uploaded collections
+        journal: Journal checkpointing the run's progress
+        resume: Continue the run recorded in journal, routing its pending
+            items by the changes it recorded and replaying the collection
+            changes it hadn't uploaded
+        deadline: time.monotonic() value after which no item is started.
+            Items are processed cheapest first, and those that wouldn't
+            finish in time are left pending in journal for the next run.
+        artifact: ShardArtifact receiving the collection changes and item
+            states of a sharded run instead of uploading collections, saved
+            every flush_every items. scripts.finalize publishes them.
+    """
     n_items = len(metadata)
     logger.info(f"IIIF: {cf.GREEN}{n_items}{cf.RESET} to process")
     vocabulary = get_vocabulary(VOCABULARY)
-    collections = get_collections(metadata) if not testing else {}
+    changes = dict(changes or {})
+    if journal is not None and resume:
+        # The hashes of pending items were saved by the interrupted run, so
+        # their changes are only known to the journal
+        for id, fields in journal.changes().items():
+            changes[id] = {**changes.get(id, {}), **fields}
+    removed = removed if removed is not None else metadata.iloc[:0]
+    previous_labels = {
+        id: set(split_labels(fields[MF.COLLECTION]))
+        for id, fields in changes.items()
+        if MF.COLLECTION in fields
+    }
+    replay, replay_removals = {}, {}
+    if journal is not None and resume:
+        replay = journal.collection_changes()
+        replay_removals = journal.collection_removals()
+    if artifact is not None:
+        collections = artifact.collections
+    elif not testing:
+        extra_labels = [*replay, *replay_removals, *chain(*previous_labels.values())]
+        extra_labels += [label for value in removed["Collection"] for label in split_labels(value)]
+        collections = get_collections(metadata, extra_labels)
+    else:
+        collections = {}
+    if journal is not None and not testing:
+        journal.begin(metadata.index, resume, changes)
+    for name, references in replay.items():
+        logger.info(
+            f"Replaying {cf.GREEN}{len(references)}{cf.RESET} changes to collection "
+            f"{name} from the interrupted run"
+        )
+        for reference in references:
+            collections[name].add_reference(ManifestRef(**json.loads(reference)))
+    for name, ids in replay_removals.items():
+        for id in ids:
+            collections[name].remove(manifest_id(id))
+
+    for id, value in removed["Collection"].items():
+        labels = split_labels(value)
+        logger.info(f"Item {id} was unpublished, removing it from collections {labels}")
+        for name in labels:
+            collections[name].remove(manifest_id(id))
+        if journal is not None:
+            journal.complete(id, removals=labels)
     n_manifests = 0
+    n_published = 0
+    n_unchanged = 0
+    n_membership = 0
+    n_not_modified = 0
+    bytes_not_downloaded = 0
+    max_peak_rss = 0
+    upload_stats = {"uploaded": 0, "skipped": 0, "deleted": 0, "bytes_skipped": 0}
     errors = []
     no_collection = metadata.loc[metadata["Collection"].isna()].index.to_list()
+    store = StateStore()
+    s3_index = S3Index()
+    start = time.perf_counter()
+    reset_peak_rss()  # this process's peak then covers downloads, uploads and threaded tiling
+
+    rows = metadata.fillna("")
+    retile, membership = route_changes(changes)
+    states = resolve_states(rows.index, store, set(stale) | retile)
+    tile_flags = {id: needs_tiling(state, testing) for id, state in states.items()}
+    membership = [id for id in rows.index if id in membership and not tile_flags[id]]
+    n_to_tile = sum(tile_flags.values())
+    logger.info(
+        f"{cf.GREEN}{n_items - n_to_tile}{cf.RESET} items already tiled, "
+        f"{cf.GREEN}{n_to_tile}{cf.RESET} need tiling"
+    )
+    unhashed = [id for id, state in states.items() if not state.get("manifest_hash")]
+    if not testing and unhashed:
+        # Listing iiif/ would page through every tile, so only their manifests are read
+        s3_index.head_many(f"iiif/{id}/manifest.json" for id in unhashed)
+    deferred = []
+    if testing:
+        results = _process_serial(rows, vocabulary, testing, force, states)
+    else:
+        costs = estimate_costs(states, tile_flags, store.timings())
+        rows = rows.loc[order_by_cost(rows.index, tile_flags, costs)]
+        if deadline is not None:
+            logger.info(
+                f"Estimated {cf.GREEN}{sum(costs.values()) / 60:.0f}{cf.RESET} min of "
+                f"work, {cf.GREEN}{(deadline - time.monotonic()) / 60:.0f}{cf.RESET} min left"
+            )
+        if workers > 1:
+            logger.info(f"Tiling with {cf.GREEN}{workers}{cf.RESET} worker processes")
+        if membership:
+            logger.info(
+                f"{cf.GREEN}{len(membership)}{cf.RESET} items only changed collections, "
+                f"skipping their sources and manifests"
+            )
+        results = _process_pipeline(
+            rows.drop(index=membership),
+            vocabulary,
+            force,
+            states,
+            workers,
+            sync=sync,
+            delete_orphans=delete_orphans,
+            costs=costs,
+            deadline=deadline,
+            deferred=deferred,
+        )
+        # Collection-only changes need nothing but the stored sizes
+        results = chain(
+            ((id, rows.loc[id], {"sizes": states[id]["sizes"]}, None) for id in membership),
+            results,
+        )
 
-    for index, (id, row) in enumerate(metadata.fillna("").iterrows()):
+    # Manifests and collections are only ever touched here, in the parent
+    for index, (id, row, result, error) in enumerate(results):
         logger.info(f"{cf.LIGHT_BLUE}{index+1}/{n_items}{cf.BLUE} - Parsing item {id}")
         try:
+            if error:
+                raise error
+            sizes = result["sizes"]
+            max_peak_rss = max(max_peak_rss, result.get("peak_rss", 0))
+            if "upload" in result and invalidations is not None:
+                invalidations.add_prefix(f"iiif/{id}/")  # tiles and info.json
+            if result.get("not_modified"):
+                n_not_modified += 1
+                bytes_not_downloaded += states[id].get("source_bytes") or 0
+            upload = dict(result.get("upload", {}))
+            s3_index.record_many(upload.pop("objects", []))
+            for key in upload.pop("orphans", []):
+                s3_index.discard(key)
+            for name, value in upload.items():
+                upload_stats[name] += value
             item = Item(id, row, vocabulary)
-            sizes = item.get_sizes()
-            if not sizes or testing or RETILE == "true": # github action input, not boolean
-                sizes = item.tile_image()
             manifest = item.create_manifest(sizes)
-            
+            manifest_json = manifest.json(indent=4)
+
             if testing:
                 os.makedirs(f"iiif/{item._id}", exist_ok=True)
                 with open(f"iiif/{item._id}/manifest.json", 'w', encoding="utf-8") as f:
-                    f.write(manifest.json(indent=4))
+                    f.write(manifest_json)
                 logger.info(f"Saved manifest locally to iiif/{item._id}/manifest.json")
             else:
-                upload_object_to_s3(manifest.json(), item._id, f"iiif/{item._id}/manifest.json")
+                if id in membership:
+                    manifest_hash = states[id].get("manifest_hash")
+                    n_membership += 1
+                else:
+                    published, manifest_hash = publish_manifest(
+                        id, manifest_json, states[id].get("manifest_hash"), s3_index
+                    )
+                    if manifest_hash is None:
+                        raise IOError(f"Failed to upload manifest for item {id}")
+                    if published:
+                        n_published += 1
+                        if invalidations is not None:
+                            invalidations.add(f"iiif/{id}/manifest.json")
+                    else:
+                        n_unchanged += 1
                 for name in item.get_collections():
-                    collection = collections[name]
-                    collection.items = [
-                        ref for ref in collection.items if ref.id != manifest.id
-                    ]
-                    collection.add_item_by_reference(manifest)
+                    collections[name].add(manifest)
+                left = previous_labels.get(id, set()) - set(item.get_collections())
+                for name in left:
+                    collections[name].remove(manifest.id)
+                fields = {
+                    field: value
+                    for field, value in result.items()
+                    if field in COLUMNS and value is not None
+                }
+                fields.update(sizes=sizes, manifest_hash=manifest_hash)
+                store.update(id, **fields)
+                if artifact is not None:
+                    artifact.states[id] = fields
+                if journal is not None:
+                    reference = manifest.to_reference().json()
+                    journal.complete(
+                        id, {name: reference for name in item.get_collections()}, left
+                    )
             n_manifests += 1
         except Exception:
             logger.exception(
-                f"{cf.RED}Couldn't create manifest for item {item._id}, skipping"
+                f"{cf.RED}Couldn't create manifest for item {id}, skipping"
             )
-            errors.append(item._id)
+            errors.append(id)
+            if journal is not None and not testing:
+                journal.complete(id)
+        if not testing and (index + 1) % flush_every == 0:
+            if artifact is not None:
+                save_artifact(artifact, invalidations)
+            else:
+                flush_collections(collections, invalidations, journal)
 
-    if not testing:
-        for name in collections.keys():
-            upload_object_to_s3(
-                collections[name].json(), name, f"iiif/collection/{name.lower()}.json"
+    if deferred:
+        logger.warning(
+            f"{cf.YELLOW}Deadline reached, {len(deferred)} items left for the next run "
+            f"(use --resume){cf.RESET}"
+        )
+    if artifact is not None:
+        save_artifact(artifact, invalidations)
+        if journal is not None and not deferred:
+            journal.finish()
+    elif not testing:
+        if flush_collections(collections, invalidations, journal):
+            if journal is not None and not deferred:
+                journal.finish()
+        else:
+            logger.warning(
+                f"{cf.YELLOW}Some collections failed to upload, run again with "
+                f"--resume to retry{cf.RESET}"
             )
 
+    store.close()
+    s3_index.close()
+    max_peak_rss = max(max_peak_rss, peak_rss())
+
     return {
         "n_manifests": n_manifests,
+        "n_published": n_published,
+        "n_unchanged": n_unchanged,
+        "n_membership": n_membership,
+        "n_removed": len(removed),
         "n_items": n_items,
         "no_collection": no_collection,
         "errors": errors,
+        "n_not_modified": n_not_modified,
+        "bytes_not_downloaded": bytes_not_downloaded,
+        "max_peak_rss": max_peak_rss,
+        "n_tiles_uploaded": upload_stats["uploaded"],
+        "n_tiles_skipped": upload_stats["skipped"],
+        "bytes_not_uploaded": upload_stats["bytes_skipped"],
+        "n_orphans_deleted": upload_stats["deleted"],
+        "deferred": deferred,
+        "elapsed": time.perf_counter() - start,
     }
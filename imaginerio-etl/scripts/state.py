@@ -0,0 +1,93 @@
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from ..config import BUCKET_NAME, FETCH_THREADS, STATE_DB
+from ..utils import helpers
+from ..utils.logger import CustomFormatter as cf
+from ..utils.logger import logger
+from ..utils.s3index import S3Index
+from ..utils.state import StateStore, hash_manifest
+
+
+def list_item_ids(bucket=BUCKET_NAME):
+    """List the ids of every item folder under iiif/ in the bucket"""
+    paginator = helpers.s3_client.get_paginator("list_objects_v2")
+    ids = []
+    for page in paginator.paginate(Bucket=bucket, Prefix="iiif/", Delimiter="/"):
+        for prefix in page.get("CommonPrefixes", []):
+            id = prefix["Prefix"][len("iiif/") : -1]
+            if id != "collection":
+                ids.append(id)
+    return ids
+
+
+def _get_object(bucket, key):
+    try:
+        return helpers.s3_client.get_object(Bucket=bucket, Key=key)
+    except helpers.s3_client.exceptions.NoSuchKey:
+        return None
+
+
+def fetch_item_state(id, bucket=BUCKET_NAME):
+    """Read an item's sizes and manifest hash from its published files.
+
+    Returns:
+        Dictionary of state fields, or None if the item has no info.json
+    """
+    try:
+        info = _get_object(bucket, f"iiif/{id}/info.json")
+        if info is None:
+            return None
+        state = {
+            "sizes": json.loads(info["Body"].read())["sizes"],
+            "processed_at": info["LastModified"].isoformat(),
+        }
+        manifest = _get_object(bucket, f"iiif/{id}/manifest.json")
+        if manifest is not None:
+            state["manifest_hash"] = hash_manifest(manifest["Body"].read())
+        return state
+    except Exception as e:
+        logger.error(f"{cf.RED}Couldn't read state of item {id}: {e}")
+        return None
+
+
+def rebuild(store, bucket=BUCKET_NAME, threads=FETCH_THREADS):
+    """Refill the state store from the bucket, keeping stored source hashes"""
+    ids = list_item_ids(bucket)
+    logger.info(f"Rebuilding state for {cf.GREEN}{len(ids)}{cf.RESET} items in {bucket}")
+    n_items = 0
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        states = executor.map(lambda id: fetch_item_state(id, bucket), ids)
+        for id, state in zip(ids, states):
+            if state:
+                store.update(id, commit=False, **state)
+                n_items += 1
+    store.commit()
+    logger.info(f"Stored state for {cf.GREEN}{n_items}{cf.RESET} items")
+    return n_items
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the local item state store.")
+    parser.add_argument("command", choices=["rebuild", "index"])
+    parser.add_argument("--bucket", default=BUCKET_NAME)
+    parser.add_argument("--path", default=STATE_DB, help="State store file")
+    parser.add_argument(
+        "--prefix", default="iiif/", help="Prefix to sweep into the S3 index (index)"
+    )
+    args = parser.parse_args()
+
+    if args.command == "index":
+        with S3Index(bucket=args.bucket) as index:
+            n_objects = index.refresh(args.prefix)
+        logger.info(f"Indexed {cf.GREEN}{n_objects}{cf.RESET} objects under {args.prefix}")
+        return
+
+    with StateStore(args.path) as store:
+        if args.command == "rebuild":
+            rebuild(store, args.bucket)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,97 @@
 import argparse
 import os
+import time
+
+import pandas as pd
 
 from ..config import (
+    BUDGET,
+    BUDGET_MARGIN,
     CURRENT_JSTOR,
+    INVALIDATE,
+    JOURNAL,
+    RESUME,
     NEW_JSTOR,
-    KMLS_IN
+    KMLS_IN,
+    WORKERS,
 )
 from ..utils.helpers import get_metadata_changes, summarize, load_xls
+from ..utils.invalidation import Invalidations
+from ..utils.journal import Journal
 from ..utils.logger import logger
+from ..utils.shard import ShardArtifact, parse_shard, select_shard
+from ..utils.state import StateStore
 from . import iiif, viewcones
 
 
 def main():
+    start = time.monotonic()
     parser = argparse.ArgumentParser(description="Run JSTOR ETL update process.")
     parser.add_argument("--id", help="Process only the row with this index from NEW_JSTOR")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Number of processes used to tile images (default: 1, serial)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Retile even when the source image hash matches the last run",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Only upload tiles that differ from the published ones",
+    )
+    parser.add_argument(
+        "--delete-orphans",
+        action="store_true",
+        help="With --sync, delete published tiles the new pyramid doesn't have",
+    )
+    parser.add_argument(
+        "--invalidate",
+        choices=["submit", "dry-run", "off"],
+        default=INVALIDATE,
+        help="Invalidate the CloudFront paths touched by the run once it ends, "
+        "or only report them (default: dry-run)",
+    )
+    parser.add_argument(
+        "--check-sizes",
+        action="store_true",
+        help="Retile published items whose source dimensions changed, "
+        "probing only image headers",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=BUDGET,
+        help="Minutes the run may take, items that wouldn't finish in time are "
+        "left for the next run (default: no limit)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=RESUME == "true", # github action input, not boolean
+        help="Continue an interrupted run from its checkpoint",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="Only process shard i/n of the items (e.g. 2/4) and save what must be "
+        "published once to an artifact, run scripts.finalize when all shards are done",
+    )
     args = parser.parse_args()
+    if args.shard and args.id:
+        parser.error("--shard can't be combined with --id")
+
+    journal_path = JOURNAL
+    if args.shard:
+        root, ext = os.path.splitext(JOURNAL)
+        journal_path = f"{root}-{args.shard[0]}-of-{args.shard[1]}{ext}"
+    journal = Journal(journal_path) if not args.id else None
 
+    changes, removed = None, None
     if args.id: # Run a single item for testing 
         try:
             changed_data = load_xls(NEW_JSTOR, "SSID").loc[[args.id]]
@@ -24,21 +100,98 @@ def main():
             logger.error(f"ID '{args.id}' not found in NEW_JSTOR index.")
             return
     else: # Compare data, overwrite current data file if there are changes
-        all_data, changed_data = get_metadata_changes(CURRENT_JSTOR, NEW_JSTOR)
+        all_data, changed_data, changes, removed = get_metadata_changes(
+            CURRENT_JSTOR, NEW_JSTOR
+        )
+
+    if not args.id:
+        published = all_data.drop(columns=["Notes"]).loc[
+            all_data["Status"] == "In imagineRio"
+        ]
+        if args.shard:
+            published = select_shard(published, *args.shard)
+            changed_data = select_shard(changed_data, *args.shard)
+            removed = select_shard(removed, *args.shard)
+            logger.info(
+                f"Shard {args.shard[0]}/{args.shard[1]}: {len(changed_data)} changed items"
+            )
+
+    resume = False
+    if journal is not None and journal.active():
+        if args.resume:
+            pending = published.index.intersection(journal.pending())
+            logger.info(f"Resuming interrupted run, {len(pending)} items left")
+            pending = pending.difference(changed_data.index)
+            changed_data = pd.concat([changed_data, published.loc[pending]])
+            resume = True
+        else:
+            logger.warning(
+                "Discarding the checkpoint of an interrupted run, "
+                "use --resume to continue it"
+            )
+
+    stale = []
+    if args.check_sizes and not args.id:
+        with StateStore() as store:
+            stale = iiif.find_stale_items(published, store)
+        new_ids = published.index.intersection(stale).difference(changed_data.index)
+        stale_data = published.loc[new_ids]
+        changed_data = pd.concat([changed_data, stale_data])
 
-    # Update viewcones if any
-    if any(file for file in os.listdir(KMLS_IN) if file != ".gitkeep"):
+    # Update viewcones if any, on a single shard
+    if args.shard and args.shard[0] != 1:
+        viewcones_info = None
+    elif any(file for file in os.listdir(KMLS_IN) if file != ".gitkeep"):
         viewcones_info = viewcones.update(all_data)
     else:
         logger.info("No KMLs to process, skipping")
         viewcones_info = None
 
+    invalidations = (
+        Invalidations(dry_run=args.invalidate == "dry-run")
+        if args.invalidate != "off" and not args.id
+        else None
+    )
+
+    artifact = None
+    if args.shard:
+        artifact = ShardArtifact(*args.shard)
+        if resume and os.path.exists(artifact.path):
+            artifact = ShardArtifact.load(artifact.path)
+            if invalidations is not None:
+                for path in artifact.invalidations:
+                    invalidations.add(path)
+
     # Update manifests if published items data has changed
-    if changed_data.empty:
+    if changed_data.empty and (removed is None or removed.empty) and not resume:
         logger.info("No metadata changes detected, exiting")
         manifest_info = None
     else:
-        manifest_info = iiif.update(changed_data, testing=args.id is not None)
+        manifest_info = iiif.update(
+            changed_data,
+            testing=args.id is not None,
+            workers=args.workers,
+            force=args.force,
+            stale=stale,
+            sync=args.sync or args.delete_orphans,
+            delete_orphans=args.delete_orphans,
+            invalidations=invalidations,
+            journal=journal,
+            resume=resume,
+            deadline=start + args.budget * 60 - BUDGET_MARGIN if args.budget else None,
+            artifact=artifact,
+            changes=changes,
+            removed=removed,
+        )
+    if journal is not None:
+        journal.close()
+
+    if artifact is not None:
+        # Collections and invalidations are published once by scripts.finalize
+        artifact.summary = manifest_info or {}
+        logger.info(f"Saved shard artifact to {artifact.save()}")
+    elif invalidations is not None:
+        invalidations.submit()
 
     if viewcones_info or manifest_info:
         summary = summarize(viewcones_info, manifest_info)
@@ -0,0 +1,99 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from ..config import DOWNLOAD_CACHE, DOWNLOAD_CACHE_SIZE
+from .logger import CustomFormatter as cf
+from .logger import logger
+
+
+def _link_or_copy(source, destination):
+    """Hard link source to destination, copying instead across filesystems"""
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    tmp_path = f"{destination}.{os.getpid()}.tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+class DownloadCache:
+    """Content-addressed on-disk cache of downloaded source images.
+
+    Images are stored once under their SHA-256 in blobs/, and keys/ maps a
+    source URL plus its ETag (or Last-Modified) to the image's digest, so an
+    image is fetched again only when its validator changes. When the blobs
+    exceed max_bytes, the least recently used ones are evicted.
+
+    Only files are used for bookkeeping, so worker processes can share a cache.
+    """
+
+    def __init__(self, root=DOWNLOAD_CACHE, max_bytes=DOWNLOAD_CACHE_SIZE):
+        self._root = root
+        self._max_bytes = max_bytes
+
+    def _key_path(self, url, validator):
+        key = hashlib.sha256(f"{url}\n{validator}".encode("utf-8")).hexdigest()
+        return os.path.join(self._root, "keys", key)
+
+    def _blob_path(self, digest):
+        return os.path.join(self._root, "blobs", digest[:2], digest)
+
+    def get(self, url, validator, destination):
+        """Copy the cached image for url/validator to destination.
+
+        Returns:
+            SHA-256 hex digest of the image, or None on a cache miss
+        """
+        try:
+            with open(self._key_path(url, validator), "r") as f:
+                digest = f.read().strip()
+            blob_path = self._blob_path(digest)
+            _link_or_copy(blob_path, destination)
+        except FileNotFoundError:
+            return None
+        os.utime(blob_path)  # mark as recently used
+        logger.info(f"{cf.BLUE}Using cached image for {url}{cf.RESET}")
+        return digest
+
+    def put(self, url, validator, path, digest):
+        """Add the image at path, whose SHA-256 is digest, to the cache"""
+        blob_path = self._blob_path(digest)
+        if os.path.exists(blob_path):
+            os.utime(blob_path)
+        else:
+            _link_or_copy(path, blob_path)
+        key_path = self._key_path(url, validator)
+        os.makedirs(os.path.dirname(key_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(key_path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(digest)
+        os.replace(tmp_path, key_path)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used images until the cache fits in max_bytes"""
+        blobs = []
+        for root, _, files in os.walk(os.path.join(self._root, "blobs")):
+            for file in files:
+                try:
+                    stat = os.stat(os.path.join(root, file))
+                except FileNotFoundError:
+                    continue  # evicted by another process
+                blobs.append((stat.st_mtime, stat.st_size, os.path.join(root, file)))
+        total = sum(size for _, size, _ in blobs)
+        for _, size, path in sorted(blobs):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.debug(f"Evicted {path} from download cache")
@@ -1,12 +1,18 @@
+import hashlib
+import json
 import os
 import re
+import resource
 import sys
-from datetime import datetime
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from json import JSONDecodeError
 
 import boto3
 import pandas as pd
 import requests
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from iiif_prezi3 import Collection
 from pyproj import Proj
 from requests.adapters import HTTPAdapter
@@ -18,72 +24,239 @@ from ..config import (
     REPROCESS,
     CLOUDFRONT,
     BUCKET_NAME,
-    DISTRIBUTION_ID,
+    COLLECTIONS_CACHE,
+    FETCH_THREADS,
+    METADATA_HASHES,
+    MULTIPART_CHUNK_SIZE,
+    MULTIPART_THREADS,
+    MULTIPART_THRESHOLD,
+    S3_ENDPOINT_URL,
+    UPLOAD_ITEMS,
+    UPLOAD_THREADS,
     IIIFConfig as IC,
 )
+from ..entities.collection import LazyCollections
+from .invalidation import Invalidations
 from .logger import CustomFormatter as cf
 from .logger import logger
+from .metadata_hash import diff_hashes, hash_metadata, load_hashes, save_hashes
 
 # from lxml import etree
 
-s3_client = boto3.client("s3")
+
+def create_s3_client():
+    """S3 client whose connection pool can serve every upload thread at once.
+
+    Requests, including each part of a multipart upload, are retried on
+    throttling and transient errors.
+    """
+    return boto3.client(
+        "s3",
+        endpoint_url=S3_ENDPOINT_URL,
+        config=Config(
+            max_pool_connections=UPLOAD_ITEMS * (UPLOAD_THREADS + MULTIPART_THREADS),
+            retries={"max_attempts": 5, "mode": "adaptive"},
+        ),
+    )
+
+
+s3_client = create_s3_client()
+
+# Tiles are small, so each one is sent in a single PUT on the calling thread
+# instead of spinning up a transfer thread pool per file
+tile_transfer_config = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD, use_threads=False
+)
+# Large files are split in parts uploaded by their own threads
+large_transfer_config = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD,
+    multipart_chunksize=MULTIPART_CHUNK_SIZE,
+    max_concurrency=MULTIPART_THREADS,
+)
 
 session = requests.Session()
 retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504])
-session.mount("http://", HTTPAdapter(max_retries=retries))
-session.mount("https://", HTTPAdapter(max_retries=retries))
+# Pool sized so concurrent fetches reuse connections instead of opening new ones
+session.mount("http://", HTTPAdapter(max_retries=retries, pool_maxsize=FETCH_THREADS))
+session.mount("https://", HTTPAdapter(max_retries=retries, pool_maxsize=FETCH_THREADS))
 
 float2str = lambda x: x.split(".")[0]
 
 
+def reset_clients():
+    """Drop network clients inherited from a parent process (call after fork)"""
+    global s3_client
+    s3_client = create_s3_client()
+    session.close()
+
+
+def dump_json_atomic(obj, path, **kwargs):
+    """Write obj as JSON to path so readers never see a partially written file"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(obj, f, **kwargs)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def reset_peak_rss():
+    """Reset this process's peak resident memory, so peak_rss covers what follows.
+
+    Only possible on Linux, elsewhere peak_rss keeps reporting the lifetime peak.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 # def get_items(metadata, vocabulary):
 #     return [Item(id, row, vocabulary) for id, row in metadata.fillna("").iterrows()]
 
 
-def get_collections(metadata):  # , index
-    collections = {}
+def fetch_collection(label, cache_dir=COLLECTIONS_CACHE):
+    """Fetch a published collection's JSON, revalidating a local copy by ETag.
+
+    Returns:
+        The collection as a dictionary, or None if it isn't published
+    """
+    url = f"{CLOUDFRONT}/collection/{label.lower()}.json"
+    cache_path = os.path.join(cache_dir, f"{label.lower()}.json")
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        headers = {"If-None-Match": cached["etag"]}
+    except (FileNotFoundError, JSONDecodeError, KeyError):
+        cached, headers = None, {}
+
+    response = session.get(url, headers=headers)
+    if response.status_code == 304:
+        logger.debug(f"Collection {label} unchanged, using cached copy")
+        return cached["collection"]
+    try:
+        data = response.json()
+    except JSONDecodeError:
+        return None
+    if response.headers.get("ETag"):
+        dump_json_atomic(
+            {"etag": response.headers["ETag"], "collection": data}, cache_path
+        )
+    return data
+
+
+def get_collections(metadata, extra_labels=()):  # , index
+    """Load every collection referenced in metadata, fetching them concurrently.
+
+    Collections are parsed into IIIF objects only when first accessed.
+
+    Args:
+        extra_labels: Labels of other collections to load
+    """
     # list all collection names
     labels = metadata["Collection"].dropna().str.split("|").explode().unique()
-    # create collection(s)
-    for label in labels:
-        # if index == "all":
-        #     collection = create_collection(label)
-        #     collections[label] = collection
-        # else:
-        try:
-            response = requests.get(
-                f"https://iiif.imaginerio.org/iiif/collection/{label.lower()}.json"
-            )
-            collection = Collection(**response.json())
-        except JSONDecodeError:
-            collection = create_collection(label)
-        collections[label] = collection
-    return collections
+    return load_collections([*labels, *extra_labels])
+
+
+def load_collections(labels):
+    """Load the collections with the given labels, fetching them concurrently.
+
+    Collections that aren't published yet are created when first accessed.
+    """
+    labels = list(dict.fromkeys(labels))
+    with ThreadPoolExecutor(max_workers=FETCH_THREADS) as executor:
+        sources = dict(zip(labels, executor.map(fetch_collection, labels)))
+    return LazyCollections(sources, create_collection)
+
+
+def fetch_sizes(info_url):
+    """Return the sizes listed in a published info.json, or None if there's none"""
+    try:
+        return session.get(info_url).json()["sizes"]
+    except JSONDecodeError:
+        return None
+
+
+def prefetch_sizes(ids, threads=FETCH_THREADS):
+    """Fetch the published sizes of many items concurrently.
+
+    Returns:
+        Dictionary of item id -> sizes (None if the item has no info.json).
+        Items whose request failed, or whose info.json has no sizes, are left
+        out, so they can be fetched again later and fail on their own.
+    """
+    sizes = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {
+            executor.submit(fetch_sizes, f"{CLOUDFRONT}/{id}/info.json"): id
+            for id in ids
+        }
+        for future, id in futures.items():
+            try:
+                sizes[id] = future.result()
+            except (requests.RequestException, KeyError, TypeError) as e:
+                logger.warning(
+                    f"{cf.YELLOW}Couldn't prefetch sizes for item {id}: {e!r}{cf.RESET}"
+                )
+    return sizes
 
 
-def get_metadata_changes(current_file, new_file):
-    # Load current (filtered) file
-    current_data = load_xls(current_file, "SSID")
+def get_metadata_changes(current_file, new_file, hashes_path=METADATA_HASHES):
+    """Compare the downloaded metadata export with the previous run's.
 
+    Values are compared by their hashes, saved by the previous run. The
+    first run without them hashes current_file instead.
+
+    Returns:
+        Tuple of (new_data, changed_data, changes, removed), see
+        diff_hashes. When every published item must be reprocessed, each
+        one is in changes, with Status marking it as changed.
+    """
     # Load downloaded file and filter data
     new_data = load_xls(new_file, "SSID")
     filtered_new_data = new_data.drop(columns=["Notes"]).loc[
         new_data["Status"] == "In imagineRio"
     ]
 
-    # Compare files and get changed rows
-    comparison = filtered_new_data.compare(current_data, keep_shape=True)
-    changes = comparison.notna().any(axis=1)
-    changed_data = filtered_new_data[changes]
+    previous = load_hashes(hashes_path)
+    if previous is None:
+        current_data = load_xls(current_file, "SSID")
+        previous = hash_metadata(current_data), current_data["Collection"]
+
+    # Compare hashes and get changed rows
+    hashes = hash_metadata(filtered_new_data)
+    changes, removed = diff_hashes(*previous, hashes)
+    changed_data = filtered_new_data.loc[[id for id in filtered_new_data.index if id in changes]]
 
     # Replace current with new filtered data if any
-    if not changed_data.empty:
-        new_file = filtered_new_data.to_excel(current_file, engine="openpyxl")
+    if changes or not removed.empty:
+        filtered_new_data.to_excel(current_file, engine="openpyxl")
+        save_hashes(hashes, filtered_new_data["Collection"], hashes_path)
 
     if REPROCESS == "true": # github action input, not boolean
+        # Every item is rebuilt as if added, those that moved are still
+        # removed from their previous collections
         changed_data = filtered_new_data
+        changes = {id: {**changes.get(id, {}), "Status": None} for id in changed_data.index}
 
-    return new_data, changed_data
+    return new_data, changed_data, changes, removed
 
 
 def get_vocabulary(vocabulary_path):
@@ -123,6 +296,56 @@ def summarize(viewcones_info, manifests_info):
             f"items and created/updated {cf.GREEN}{manifests_info['n_manifests']}{cf.RESET} IIIF manifests. "
         )
 
+        if "n_published" in manifests_info:
+            summary += (
+                f"Published {cf.GREEN}{manifests_info['n_published']}{cf.RESET} manifests, "
+                f"skipped {cf.GREEN}{manifests_info['n_unchanged']}{cf.RESET} unchanged ones. "
+            )
+
+        if manifests_info.get("n_membership") or manifests_info.get("n_removed"):
+            summary += (
+                f"Updated the collections of {cf.GREEN}{manifests_info['n_membership']}{cf.RESET} "
+                f"items without rebuilding their manifests, and removed "
+                f"{cf.GREEN}{manifests_info['n_removed']}{cf.RESET} unpublished items from "
+                f"their collections. "
+            )
+
+        if manifests_info.get("n_not_modified"):
+            summary += (
+                f"{cf.GREEN}{manifests_info['n_not_modified']}{cf.RESET} source images weren't "
+                f"modified since their last download, saving "
+                f"{manifests_info['bytes_not_downloaded'] / 1024**2:.0f} MB of downloads "
+                f"and their tiling. "
+            )
+
+        if manifests_info.get("n_tiles_skipped") or manifests_info.get("n_orphans_deleted"):
+            summary += (
+                f"Uploaded {cf.GREEN}{manifests_info['n_tiles_uploaded']}{cf.RESET} tiles and "
+                f"skipped {cf.GREEN}{manifests_info['n_tiles_skipped']}{cf.RESET} unchanged ones, "
+                f"saving as many PUT requests and "
+                f"{manifests_info['bytes_not_uploaded'] / 1024**2:.0f} MB of uploads. "
+                f"Deleted {manifests_info['n_orphans_deleted']} orphaned tiles. "
+            )
+
+        if manifests_info.get("max_peak_rss"):
+            summary += (
+                f"Peak memory of the run, or of a tiling process, was "
+                f"{manifests_info['max_peak_rss'] / 1024**2:.0f} MB. "
+            )
+
+        if manifests_info.get("elapsed"):
+            elapsed = manifests_info["elapsed"]
+            summary += (
+                f"Took {elapsed / 60:.1f} min "
+                f"({manifests_info['n_items'] / elapsed * 60:.1f} items/min). "
+            )
+
+        if manifests_info.get("deferred"):
+            summary += (
+                f"{cf.YELLOW}{len(manifests_info['deferred'])}{cf.RESET} items didn't fit "
+                f"in the time budget and were left for the next run. "
+            )
+
         if manifests_info.get("no_collection"):
             summary += (
                 f"Items {cf.YELLOW}{manifests_info['no_collection']}{cf.RESET} aren't associated with any collections. "
@@ -215,76 +438,303 @@ def create_collection(label):
     return collection
 
 
-def file_exists(identifier, type):
+def file_exists(identifier, type, index=None):
+    """Whether an item's info.json, manifest.json or full image is in the bucket.
+
+    Answered from the S3 index when a fresh sweep covers the key, otherwise
+    with a single HEAD request.
+
+    Args:
+        index: S3Index to query, a new one is opened and closed if not given
+    """
+    from .s3index import S3Index  # s3index depends on this module
 
     if type == "info" or type == "manifest":
         key = "iiif/{0}/{1}.json".format(identifier, type)
     else:
         key = "iiif/{0}/full/max/0/default.jpg".format(identifier)
 
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket(BUCKET_NAME)
-    objs = list(bucket.objects.filter(Prefix=key))
-    if any([obj.key == key for obj in objs]):
-        return True
-    else:
-        return False
+    own_index = index is None
+    if own_index:
+        index = S3Index()
+    try:
+        if index.is_fresh(key):
+            return index.exists(key)
+        return get_etag(key) is not None
+    finally:
+        if own_index:
+            index.close()
 
 
 def invalidate_cache(path):
-    cloudfront = boto3.client("cloudfront")
-    get_timestamp = lambda x: datetime.timestamp(x)
-    cloudfront.create_invalidation(
-        DistributionId=DISTRIBUTION_ID,
-        InvalidationBatch={
-            "Paths": {"Quantity": 1, "Items": ["/" + path]},
-            "CallerReference": str(get_timestamp(datetime.now())),
+    """Invalidate a single path. Prefer collecting a run's paths in Invalidations"""
+    invalidations = Invalidations()
+    invalidations.add(path)
+    invalidations.submit()
+
+
+def _upload_file(path, key, bucket, client, config):
+    client.upload_file(
+        path,
+        bucket,
+        key,
+        ExtraArgs={
+            "ContentType": (
+                "image/jpeg" if path.endswith(".jpg") else "application/json"
+            )
         },
+        Config=config,
     )
 
 
-def upload_folder_to_s3(source):
+def _is_large(path, large_config):
+    try:
+        return os.path.getsize(path) >= large_config.multipart_threshold
+    except OSError:  # reported when its upload fails
+        return False
+
+
+def _transfer_config(path, config=None, large_config=None):
+    """The transfer config path is uploaded with, by its size"""
+    large_config = large_config or large_transfer_config
+    if _is_large(path, large_config):
+        return large_config
+    return config or tile_transfer_config
+
+
+def upload_files_to_s3(
+    paths,
+    bucket=BUCKET_NAME,
+    client=None,
+    threads=UPLOAD_THREADS,
+    config=None,
+    root=".",
+    large_config=None,
+):
+    """Upload local files to S3 concurrently, keyed by their path relative to root.
+
+    Files of at least large_config.multipart_threshold bytes are uploaded one
+    at a time on a separate thread, each as a parallel multipart upload, so
+    they don't hold up the small files. At most 2 * threads uploads are
+    queued at any time, so memory stays bounded regardless of how many files
+    are passed.
+
+    Returns:
+        Dictionary mapping each path to True if it was uploaded, False otherwise
+    """
+    client = client or s3_client
+    config = config or tile_transfer_config
+    large_config = large_config or large_transfer_config
+    results = {}
+    pending = {}
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=threads) as executor, ThreadPoolExecutor(
+        max_workers=1
+    ) as large_executor:
+        while True:
+            for path in paths:
+                key = os.path.relpath(path, root).replace(os.sep, "/")
+                if _is_large(path, large_config):
+                    future = large_executor.submit(
+                        _upload_file, path, key, bucket, client, large_config
+                    )
+                else:
+                    future = executor.submit(
+                        _upload_file, path, key, bucket, client, config
+                    )
+                pending[future] = path
+                if len(pending) >= 2 * threads:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                error = future.exception()
+                if error:
+                    logger.error(f"{cf.RED}Failed to upload {path}: {error}")
+                results[path] = error is None
+    return results
+
+
+def upload_folder_to_s3(source, **kwargs):
+    """Upload every file under source to S3, see upload_files_to_s3"""
     logger.info(f"{cf.BLUE}Uploading {source} to S3...")
-    for root, _, files in os.walk(source):
+    paths = (
+        os.path.join(root, file) for root, _, files in os.walk(source) for file in files
+    )
+    return upload_files_to_s3(paths, **kwargs)
+
+
+def local_etag(path, config=None):
+    """The ETag S3 gives path once uploaded with config, by default the one
+    upload_files_to_s3 picks for its size.
+
+    That's the file's MD5, or for a multipart upload the MD5 of its parts'
+    MD5s followed by the number of parts.
+    """
+    config = config or _transfer_config(path)
+    with open(path, "rb") as f:
+        if os.path.getsize(path) < config.multipart_threshold:
+            return hashlib.md5(f.read()).hexdigest()
+        digests = [
+            hashlib.md5(part).digest()
+            for part in iter(lambda: f.read(config.multipart_chunksize), b"")
+        ]
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def tree_objects(source, root=".", config=None):
+    """Describe the files under source as S3 lists them once uploaded.
+
+    Returns:
+        List of (key, size, etag) tuples, keys relative to root
+    """
+    objects = []
+    for dirpath, _, files in os.walk(source):
         for file in files:
-            try:
-                path = os.path.join(root, file)
-                # logger.debug(path)
-                s3_client.upload_file(
-                    path,
-                    "imaginerio-images",
-                    path,
-                    ExtraArgs={
-                        "ContentType": (
-                            "image/jpeg"
-                            if file.endswith(".jpg")
-                            else "application/json"
-                        )
-                    },
-                )
-            except:
-                logger.error(f"{cf.RED}Failed to upload {path}")
-        # invalidate_cache(path)
+            path = os.path.join(dirpath, file)
+            key = os.path.relpath(path, root).replace(os.sep, "/")
+            objects.append(
+                (key, os.path.getsize(path), local_etag(path, _transfer_config(path, config)))
+            )
+    return objects
+
+
+def list_objects(prefix, bucket=BUCKET_NAME, client=None):
+    """List every object under prefix with one paginated sweep.
+
+    Returns:
+        Dictionary of key -> {"size", "etag"}, ETags without quotes
+    """
+    client = client or s3_client
+    paginator = client.get_paginator("list_objects_v2")
+    return {
+        obj["Key"]: {"size": obj["Size"], "etag": obj["ETag"].strip('"')}
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for obj in page.get("Contents", [])
+    }
+
 
-    # if mode == "test":
-    #     return False
-    # else:
-    #     shutil.rmtree(source)
-    #     return True
+def delete_objects(keys, bucket=BUCKET_NAME, client=None):
+    """Delete objects in batches of 1000 keys, the most a request accepts.
+
+    Returns:
+        Number of objects deleted
+    """
+    client = client or s3_client
+    keys = list(keys)
+    n_deleted = 0
+    for start in range(0, len(keys), 1000):
+        batch = keys[start : start + 1000]
+        response = client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+        )
+        errors = response.get("Errors", [])
+        for error in errors:
+            logger.error(f"{cf.RED}Failed to delete {error['Key']}: {error['Message']}")
+        n_deleted += len(batch) - len(errors)
+    return n_deleted
+
+
+def sync_folder_to_s3(
+    source,
+    root=".",
+    delete=False,
+    exclude=(),
+    bucket=BUCKET_NAME,
+    client=None,
+    threads=UPLOAD_THREADS,
+    config=None,
+):
+    """Upload the files under source that are missing or different in S3.
+
+    Remote ETags come from a single listing of source's prefix and are
+    compared with the local files' MD5s, so unchanged files cost no request.
+
+    Args:
+        root: Directory keys are relative to, see upload_files_to_s3
+        delete: Also delete remote objects under the prefix with no local
+            file, e.g. tiles of a pyramid that was sized differently
+        exclude: Keys never deleted, such as files not generated locally
+
+    Returns:
+        Dictionary with the uploaded, skipped and deleted file counts,
+        bytes_skipped, the list of paths that failed to upload and the
+        list of deleted orphan keys
+    """
+    prefix = os.path.relpath(source, root).replace(os.sep, "/") + "/"
+    remote = list_objects(prefix, bucket, client)
+    changed = []
+    local_keys = set()
+    stats = {
+        "uploaded": 0,
+        "skipped": 0,
+        "deleted": 0,
+        "bytes_skipped": 0,
+        "failed": [],
+        "orphans": [],
+    }
+    for dirpath, _, files in os.walk(source):
+        for file in files:
+            path = os.path.join(dirpath, file)
+            key = os.path.relpath(path, root).replace(os.sep, "/")
+            local_keys.add(key)
+            obj = remote.get(key)
+            size = os.path.getsize(path)
+            if obj and obj["size"] == size and obj["etag"] == local_etag(
+                path, _transfer_config(path, config)
+            ):
+                stats["skipped"] += 1
+                stats["bytes_skipped"] += size
+            else:
+                changed.append(path)
+    logger.info(
+        f"{cf.BLUE}Syncing {source} to S3: {len(changed)} new or changed files, "
+        f"{stats['skipped']} unchanged..."
+    )
+    results = upload_files_to_s3(changed, bucket, client, threads, config, root)
+    stats["uploaded"] = sum(results.values())
+    stats["failed"] = [path for path, ok in results.items() if not ok]
+    if delete:
+        orphans = [key for key in remote if key not in local_keys and key not in exclude]
+        if orphans:
+            logger.info(f"{cf.BLUE}Deleting {len(orphans)} orphaned objects under {prefix}")
+            stats["deleted"] = delete_objects(orphans, bucket, client)
+            stats["orphans"] = orphans
+    return stats
 
 
 def upload_object_to_s3(obj, name, key):
+    """Upload a IIIF object, or its already serialized JSON, to S3.
+
+    Returns:
+        True if the object was uploaded, False otherwise
+    """
     # logger.debug(f"{obj.id} -> {target}")
     try:
         s3_client.put_object(
-            Body=obj.json(indent=4),
+            Body=obj if isinstance(obj, (str, bytes)) else obj.json(indent=4),
             Bucket=BUCKET_NAME,
             Key=key,
             ContentType="application/json",
         )
         logger.info(f"{cf.GREEN}Object {name} uploaded successfully")
+        return True
     except Exception as e:
         logger.error(f"{cf.RED}Failed to upload {name} to {key}: {e}")
+        return False
+
+
+def get_etag(key, bucket=BUCKET_NAME):
+    """Return the ETag of an S3 object without quotes, or None if it doesn't exist"""
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+    except s3_client.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
 
 
 def query_wikidata(Q):
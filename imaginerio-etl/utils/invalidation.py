@@ -0,0 +1,149 @@
+import time
+
+import boto3
+
+from ..config import DISTRIBUTION_ID
+from .logger import CustomFormatter as cf
+from .logger import logger
+
+# CloudFront limits on paths of invalidations in progress at the same time
+MAX_FILES = 3000
+MAX_WILDCARDS = 15
+
+
+def _split(path):
+    return tuple(segment for segment in path.split("/") if segment)
+
+
+def _collapse_at(entries, depth, min_group):
+    """Replace groups of at least min_group entries sharing a depth-long
+    directory prefix by a wildcard on it"""
+    groups = {}
+    for entry in entries:
+        if len(entry) - 1 >= depth:
+            groups.setdefault(entry[:depth], []).append(entry)
+    collapsed = set(entries)
+    for prefix, group in groups.items():
+        if len(group) >= min_group:
+            collapsed.difference_update(group)
+            collapsed.add(prefix + ("*",))
+    return collapsed
+
+
+def collapse_paths(paths, wildcard_min=2, min_depth=2):
+    """Reduce invalidation paths to the fewest that cover them.
+
+    A directory with at least wildcard_min touched paths is invalidated with
+    a wildcard, which CloudFront bills as a single path. Directories are only
+    widened up to min_depth (e.g. /iiif/{id}/*), so a run never evicts more
+    than the items it touched, however many there are.
+
+    Args:
+        paths: Paths, ending with /* for whole directories
+
+    Returns:
+        Sorted list of paths
+    """
+    entries = {_split(path) for path in paths}
+    max_depth = max((len(entry) - 1 for entry in entries), default=0)
+    for depth in range(max_depth, min_depth - 1, -1):
+        entries = _collapse_at(entries, depth, wildcard_min)
+    return sorted("/" + "/".join(entry) for entry in entries)
+
+
+def batch_paths(paths, max_files=MAX_FILES, max_wildcards=MAX_WILDCARDS):
+    """Split paths into batches that each fit in the invalidations in progress.
+
+    Returns:
+        List of lists of paths
+    """
+    batches = []
+    files = wildcards = 0
+    for path in paths:
+        wildcard = path.endswith("*")
+        full = wildcards + wildcard > max_wildcards or files + (not wildcard) > max_files
+        if not batches or full:
+            batches.append([])
+            files = wildcards = 0
+        batches[-1].append(path)
+        wildcards += wildcard
+        files += not wildcard
+    return batches
+
+
+class Invalidations:
+    """Collects the CloudFront paths a run touches and invalidates them at once.
+
+    Invalidating one path per request hits CloudFront's limits and is billed
+    per path, so paths are gathered during the run, collapsed into wildcards
+    where that's cheaper and submitted at once by submit. Paths that don't fit
+    in the invalidations CloudFront allows in progress are sent in further
+    batches, each once the previous one completed.
+
+    Args:
+        distribution_id: CloudFront distribution serving the bucket
+        dry_run: Only log what would be invalidated
+    """
+
+    def __init__(self, distribution_id=DISTRIBUTION_ID, dry_run=False):
+        self._distribution_id = distribution_id
+        self._dry_run = dry_run
+        self._paths = set()
+
+    def __len__(self):
+        return len(self._paths)
+
+    def add(self, key):
+        """Invalidate an object, given its S3 key"""
+        self._paths.add("/" + key.lstrip("/"))
+
+    def add_prefix(self, prefix):
+        """Invalidate every object under an S3 prefix"""
+        self._paths.add("/" + prefix.strip("/") + "/*")
+
+    def touched(self):
+        """Paths added so far, before collapsing"""
+        return sorted(self._paths)
+
+    def paths(self):
+        return collapse_paths(self._paths)
+
+    def submit(self):
+        """Create invalidations for every collected path, as few as fit.
+
+        Returns:
+            List of the invalidated paths, empty if there was nothing to do
+        """
+        paths = self.paths()
+        if not paths:
+            logger.info("No CloudFront paths to invalidate")
+            return []
+        batches = batch_paths(paths)
+        report = (
+            f"{len(self._paths)} touched paths collapsed to {len(paths)} "
+            f"in {len(batches)} invalidations: {paths}"
+        )
+        if self._dry_run or not self._distribution_id:
+            logger.info(f"{cf.YELLOW}Dry run, would invalidate {report}{cf.RESET}")
+            return paths
+        client = boto3.client("cloudfront")
+        for index, batch in enumerate(batches):
+            if index:
+                # The previous batch fills CloudFront's limits until it completes
+                client.get_waiter("invalidation_completed").wait(
+                    DistributionId=self._distribution_id, Id=invalidation_id
+                )
+            response = client.create_invalidation(
+                DistributionId=self._distribution_id,
+                InvalidationBatch={
+                    "Paths": {"Quantity": len(batch), "Items": batch},
+                    "CallerReference": f"{time.time()}-{index}",
+                },
+            )
+            invalidation_id = response["Invalidation"]["Id"]
+            logger.info(
+                f"{cf.GREEN}Created invalidation {invalidation_id}{cf.RESET} "
+                f"for {len(batch)} paths"
+            )
+        logger.info(f"{cf.GREEN}Invalidated {report}{cf.RESET}")
+        return paths
@@ -0,0 +1,146 @@
+import json
+import os
+import sqlite3
+
+from ..config import JOURNAL
+
+
+class Journal:
+    """Checkpoint of an iiif.update run, for resuming it if it's interrupted.
+
+    Records which items of the run are done, the metadata changes of the
+    others, and the collection changes made since collections were last
+    uploaded, each in one transaction. A resumed run skips done items, routes
+    the pending ones by their recorded changes and replays the collection
+    changes, so no progress is lost.
+    Only use a journal from the thread that opened it.
+    """
+
+    def __init__(self, path=JOURNAL):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, done INTEGER);
+            CREATE TABLE IF NOT EXISTS collection_changes (
+                label TEXT, manifest_id TEXT, reference TEXT,
+                PRIMARY KEY (label, manifest_id)
+            );
+            """
+        )
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(items)")}
+        if "changes" not in existing:
+            self._conn.execute("ALTER TABLE items ADD COLUMN changes TEXT")
+            self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def active(self):
+        """Whether a run was started and never finished"""
+        return self._conn.execute("SELECT 1 FROM items LIMIT 1").fetchone() is not None
+
+    def pending(self):
+        """Ids of the items of the unfinished run that aren't done"""
+        return [
+            row[0] for row in self._conn.execute("SELECT id FROM items WHERE done = 0")
+        ]
+
+    def changes(self):
+        """Metadata changes of the pending items that were recorded with some.
+
+        Returns:
+            Dictionary of id -> changed column -> previous value, see
+            metadata_hash.diff_hashes
+        """
+        return {
+            id: json.loads(changes)
+            for id, changes in self._conn.execute(
+                "SELECT id, changes FROM items WHERE done = 0 AND changes IS NOT NULL"
+            )
+        }
+
+    def begin(self, ids, resume=False, changes=None):
+        """Record the items of a run.
+
+        Args:
+            resume: Keep the unfinished run's progress instead of discarding it.
+                The given ids are (re)marked as pending either way.
+            changes: Dictionary of id -> changed column -> previous value, kept
+                so a resumed run can route the items the same way. Items that
+                aren't in it are fully processed.
+        """
+        changes = changes or {}
+        rows = [
+            (id, json.dumps(changes[id]) if id in changes else None) for id in ids
+        ]
+        with self._conn:
+            if not resume:
+                self._conn.execute("DELETE FROM items")
+                self._conn.execute("DELETE FROM collection_changes")
+            self._conn.executemany("INSERT OR REPLACE INTO items VALUES (?, 0, ?)", rows)
+
+    def complete(self, id, references=None, removals=()):
+        """Mark an item as done, with the collection references it added.
+
+        Args:
+            references: Dictionary of collection label -> the item's manifest
+                reference as JSON
+            removals: Labels of the collections the item was removed from,
+                recorded with a NULL reference
+        """
+        changes = [(label, id, reference) for label, reference in (references or {}).items()]
+        changes += [(label, id, None) for label in removals]
+        with self._conn:
+            self._conn.execute("UPDATE items SET done = 1 WHERE id = ?", (id,))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO collection_changes VALUES (?, ?, ?)", changes
+            )
+
+    def collection_changes(self):
+        """Collection changes not uploaded yet.
+
+        Returns:
+            Dictionary of label -> list of manifest references as JSON
+        """
+        changes = {}
+        for label, reference in self._conn.execute(
+            "SELECT label, reference FROM collection_changes "
+            "WHERE reference IS NOT NULL ORDER BY rowid"
+        ):
+            changes.setdefault(label, []).append(reference)
+        return changes
+
+    def collection_removals(self):
+        """Collection removals not uploaded yet.
+
+        Returns:
+            Dictionary of label -> list of removed item ids
+        """
+        removals = {}
+        for label, id in self._conn.execute(
+            "SELECT label, manifest_id FROM collection_changes "
+            "WHERE reference IS NULL ORDER BY rowid"
+        ):
+            removals.setdefault(label, []).append(id)
+        return removals
+
+    def flushed(self, labels):
+        """Forget the changes of collections that were uploaded"""
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM collection_changes WHERE label = ?", [(label,) for label in labels]
+            )
+
+    def finish(self):
+        """Clear the journal once the run is complete"""
+        with self._conn:
+            self._conn.execute("DELETE FROM items")
+            self._conn.execute("DELETE FROM collection_changes")
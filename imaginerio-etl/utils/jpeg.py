@@ -0,0 +1,80 @@
+import struct
+
+from .helpers import session
+
+# Start Of Frame markers, whose segment holds the image dimensions.
+# C4 (DHT), C8 (JPG) and CC (DAC) share the range but aren't frames.
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers without a length field
+STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+SOS, EOI = 0xDA, 0xD9
+
+
+def parse_jpeg_size(data):
+    """Read a JPEG's dimensions from the start of its data.
+
+    Args:
+        data: The first bytes of a JPEG file
+
+    Returns:
+        Tuple of (width, height), or None if data ends before the frame header
+
+    Raises:
+        ValueError: If data isn't a JPEG or has no frame header before the scan
+    """
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("Not a JPEG file")
+    i = 2
+    while True:
+        # Markers are 0xFF followed by a code, optionally padded with more 0xFF
+        while i < len(data) and data[i] != 0xFF:
+            i += 1
+        while i < len(data) and data[i] == 0xFF:
+            i += 1
+        if i >= len(data):
+            return None
+        marker = data[i]
+        i += 1
+        if marker in STANDALONE_MARKERS:
+            continue
+        if marker in (SOS, EOI):
+            raise ValueError("No frame header before image data")
+        if i + 2 > len(data):
+            return None
+        (length,) = struct.unpack(">H", data[i : i + 2])
+        if marker in SOF_MARKERS:
+            if i + 7 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[i + 3 : i + 7])
+            return width, height
+        i += length
+
+
+def probe_image_size(url, first_bytes=64 * 1024, max_bytes=4 * 1024**2):
+    """Get a remote JPEG's dimensions by fetching only its first bytes.
+
+    The fetched range doubles until the frame header is found, as large
+    EXIF or ICC segments can push it past the first request.
+
+    Returns:
+        Tuple of (width, height)
+
+    Raises:
+        ValueError: If the image isn't a JPEG or its header wasn't found
+            within max_bytes
+        requests.RequestException: If the request failed
+    """
+    size = first_bytes
+    while size <= max_bytes:
+        headers = {"Range": f"bytes=0-{size - 1}"}
+        with session.get(url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            # A server ignoring Range sends the whole image, only read what we need
+            data = response.raw.read(size, decode_content=True)
+        dimensions = parse_jpeg_size(data)
+        if dimensions:
+            return dimensions
+        if len(data) < size:
+            break  # that was the whole file
+        size *= 2
+    raise ValueError(f"No JPEG frame header found in the first {max_bytes} bytes of {url}")
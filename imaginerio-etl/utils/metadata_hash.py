@@ -0,0 +1,112 @@
+import os
+import sqlite3
+
+import pandas as pd
+
+from ..config import METADATA_HASHES, MetadataFields as MF
+
+
+def normalize(data):
+    """String form of every value of data, so equal values hash the same.
+
+    Missing values become empty strings, whitespace is trimmed and float
+    columns holding whole numbers (integer columns with missing values, as
+    read from Excel) lose their ".0".
+    """
+    normalized = {}
+    for column, values in data.items():
+        if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+            values = values.astype("Int64")
+        normalized[column] = values.astype("string").fillna("").str.strip()
+    return pd.DataFrame(normalized, index=data.index)
+
+
+def hash_metadata(data):
+    """Hash every value of data, a column at a time.
+
+    Returns:
+        DataFrame of int64 hashes with the index and columns of data
+    """
+    normalized = normalize(data)
+    return pd.DataFrame(
+        {
+            column: pd.util.hash_array(values.to_numpy(dtype=object)).view("int64")
+            for column, values in normalized.items()
+        },
+        index=data.index,
+    )
+
+
+def load_hashes(path=METADATA_HASHES):
+    """Load the hashes and collections saved by the previous run.
+
+    Returns:
+        Tuple of (hashes, collections), collections being the Collection
+        value of each item, or None if no run saved them
+    """
+    if not os.path.exists(path):
+        return None
+    with sqlite3.connect(path) as conn:
+        hashes = pd.read_sql("SELECT * FROM hashes", conn, index_col="SSID")
+        collections = pd.read_sql("SELECT * FROM collections", conn, index_col="SSID")
+    return hashes, collections["Collection"]
+
+
+def save_hashes(hashes, collections, path=METADATA_HASHES):
+    """Save hashes and the Collection values of the published items for the next run"""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    try:
+        with conn:
+            hashes.rename_axis("SSID").to_sql("hashes", conn, if_exists="replace")
+            collections.rename("Collection").rename_axis("SSID").to_sql(
+                "collections", conn, if_exists="replace"
+            )
+    finally:
+        conn.close()
+
+
+def diff_hashes(previous, previous_collections, hashes):
+    """Find the added, changed and removed items between two runs' hashes.
+
+    Comparisons are done on whole columns of integers, so it takes linear
+    time and little memory however many items there are.
+
+    Args:
+        previous: Hashes of the previous run's published items
+        previous_collections: Collection value of each of those items
+        hashes: Hashes of the items published now
+
+    Returns:
+        Tuple of (changes, removed): a dictionary of SSID -> dictionary of
+        changed column -> previous value, only known for Collection (None
+        otherwise), where added items only have Status, and a DataFrame with
+        the previous Collection of every removed item
+    """
+    common = hashes.index.intersection(previous.index)
+    shared = hashes.columns.intersection(previous.columns)
+    differs = pd.DataFrame(
+        hashes.loc[common, shared].to_numpy() != previous.loc[common, shared].to_numpy(),
+        index=common,
+        columns=shared,
+    )
+    # Columns that are new to the export changed for every item
+    for column in hashes.columns.difference(previous.columns):
+        differs[column] = True
+    differs = differs[differs.any(axis=1)]
+
+    changes = {}
+    for id, row in zip(differs.index, differs.to_numpy()):
+        columns = differs.columns[row]
+        changes[id] = {
+            column: previous_collections.get(id) if column == MF.COLLECTION else None
+            for column in columns
+        }
+    for id in hashes.index.difference(previous.index):
+        changes[id] = {"Status": None}
+    removed_ids = previous.index.difference(hashes.index)
+    removed = pd.DataFrame(
+        {"Collection": previous_collections.reindex(removed_ids)}, index=removed_ids
+    )
+    return changes, removed
@@ -0,0 +1,110 @@
+import queue
+import threading
+from collections import namedtuple
+
+# A pipeline step: function is called on each item by its own pool of threads
+Stage = namedtuple("Stage", ["name", "function", "workers"])
+
+_DONE = object()
+
+
+class Cancelled(Exception):
+    """Raised by a stage that gave up because the pipeline was cancelled"""
+
+
+def _put(q, entry, cancelled):
+    """Put entry in a bounded queue, giving up if the pipeline was cancelled"""
+    while not cancelled.is_set():
+        try:
+            q.put(entry, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _get(q, cancelled):
+    while not cancelled.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def run_pipeline(items, stages, queue_size=2, cancelled=None):
+    """Pass items through stages running concurrently, each with its own threads.
+
+    Stages are connected by queues holding at most queue_size items, so a slow
+    stage blocks the ones before it instead of letting work pile up: at most
+    sum(workers) + (len(stages) + 1) * queue_size items are in flight.
+
+    Items leave in the order they complete. If a stage raises, the item skips
+    the remaining stages and is yielded with the exception.
+
+    Args:
+        items: Iterable of items, consumed lazily
+        stages: List of Stage, functions take an item and return the item
+            passed to the next stage
+        queue_size: Capacity of each queue between stages
+        cancelled: threading.Event set when the consumer stops early, for
+            stages that block on something else than the queues to check
+
+    Yields:
+        Tuples of (item, exception or None)
+    """
+    cancelled = cancelled or threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    threads = []
+
+    def feed():
+        for item in items:
+            if cancelled.is_set():
+                return
+            _put(queues[0], (item, None), cancelled)
+        _put(queues[0], _DONE, cancelled)
+
+    def work(function, inbox, outbox):
+        while True:
+            entry = _get(inbox, cancelled)
+            if entry is _DONE:
+                _put(inbox, _DONE, cancelled)  # let the stage's other workers stop too
+                return
+            item, error = entry
+            if error is None:
+                try:
+                    item = function(item)
+                except Exception as e:
+                    error = e
+            _put(outbox, (item, error), cancelled)
+
+    def close(workers, outbox):
+        for thread in workers:
+            thread.join()
+        _put(outbox, _DONE, cancelled)
+
+    threads.append(threading.Thread(target=feed, name="pipeline-feed", daemon=True))
+    for stage, inbox, outbox in zip(stages, queues, queues[1:]):
+        workers = [
+            threading.Thread(
+                target=work,
+                args=(stage.function, inbox, outbox),
+                name=f"pipeline-{stage.name}-{n}",
+                daemon=True,
+            )
+            for n in range(stage.workers)
+        ]
+        threads.extend(workers)
+        threads.append(threading.Thread(target=close, args=(workers, outbox), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            entry = _get(queues[-1], cancelled)
+            if entry is _DONE:
+                return
+            yield entry
+    finally:
+        cancelled.set()
+        for thread in threads:
+            thread.join()
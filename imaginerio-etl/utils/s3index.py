@@ -0,0 +1,220 @@
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from ..config import BUCKET_NAME, FETCH_THREADS, S3_INDEX, S3_INDEX_MAX_AGE
+from . import helpers
+from .logger import CustomFormatter as cf
+from .logger import logger
+
+
+def _head_object(bucket, key):
+    """Size, ETag and last modification of an object, or None if it doesn't exist"""
+    try:
+        response = helpers.s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+    return (
+        response["ContentLength"],
+        response["ETag"].strip('"'),
+        response["LastModified"].isoformat(),
+    )
+
+
+class S3Index:
+    """Local index of the bucket's objects, filled by paginated listings.
+
+    One ListObjectsV2 sweep over a prefix records every object's size and
+    ETag, so existence, size and ETag queries need no request to S3 until the
+    sweep goes stale. Sweeps are recorded per prefix with a timestamp, which
+    lets a single item, or a single key, be refreshed without listing the
+    whole bucket.
+    Persisted in a SQLite file, only use an index from the thread that opened it.
+    """
+
+    def __init__(self, path=S3_INDEX, bucket=BUCKET_NAME, max_age=S3_INDEX_MAX_AGE):
+        self._bucket = bucket
+        self._max_age = max_age
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS objects (
+                bucket TEXT, key TEXT, size INTEGER, etag TEXT, last_modified TEXT,
+                PRIMARY KEY (bucket, key)
+            );
+            CREATE TABLE IF NOT EXISTS sweeps (
+                bucket TEXT, prefix TEXT, listed_at REAL,
+                PRIMARY KEY (bucket, prefix)
+            );
+            """
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM objects WHERE bucket = ?", (self._bucket,)
+        ).fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def refresh(self, prefix="iiif/"):
+        """List every object under prefix, replacing what was indexed there.
+
+        Returns:
+            Number of objects found
+        """
+        listed_at = time.time()
+        paginator = helpers.s3_client.get_paginator("list_objects_v2")
+        n_objects = 0
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM objects WHERE bucket = ? AND substr(key, 1, ?) = ?",
+                (self._bucket, len(prefix), prefix),
+            )
+            for page in paginator.paginate(Bucket=self._bucket, Prefix=prefix):
+                rows = [
+                    (
+                        self._bucket,
+                        obj["Key"],
+                        obj["Size"],
+                        obj["ETag"].strip('"'),
+                        obj["LastModified"].isoformat(),
+                    )
+                    for obj in page.get("Contents", [])
+                ]
+                self._conn.executemany("INSERT INTO objects VALUES (?, ?, ?, ?, ?)", rows)
+                n_objects += len(rows)
+            # A sweep covers narrower ones
+            self._conn.execute(
+                "DELETE FROM sweeps WHERE bucket = ? AND substr(prefix, 1, ?) = ?",
+                (self._bucket, len(prefix), prefix),
+            )
+            self._conn.execute(
+                "INSERT INTO sweeps VALUES (?, ?, ?)", (self._bucket, prefix, listed_at)
+            )
+        logger.debug(f"Indexed {n_objects} objects under s3://{self._bucket}/{prefix}")
+        return n_objects
+
+    def head_many(self, keys, threads=FETCH_THREADS):
+        """Index a few keys with concurrent HEAD requests instead of a sweep.
+
+        Each key is recorded as a sweep of its own, so the index answers for it
+        whether or not it exists. Keys whose request failed are left out.
+
+        Returns:
+            Number of keys indexed
+        """
+        keys = [key for key in keys if not self.is_fresh(key)]
+        listed_at = time.time()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = {executor.submit(_head_object, self._bucket, key): key for key in keys}
+            results = {}
+            for future, key in futures.items():
+                try:
+                    results[key] = future.result()
+                except (ClientError, BotoCoreError) as e:
+                    logger.warning(
+                        f"{cf.YELLOW}Couldn't index s3://{self._bucket}/{key}: {e}{cf.RESET}"
+                    )
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM objects WHERE bucket = ? AND key = ?",
+                [(self._bucket, key) for key in results],
+            )
+            self._conn.executemany(
+                "INSERT INTO objects VALUES (?, ?, ?, ?, ?)",
+                [(self._bucket, key, *obj) for key, obj in results.items() if obj],
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sweeps VALUES (?, ?, ?)",
+                [(self._bucket, key, listed_at) for key in results],
+            )
+        return len(results)
+
+    def listed_at(self, key):
+        """Timestamp of the latest sweep covering key, or None if none does"""
+        row = self._conn.execute(
+            "SELECT MAX(listed_at) FROM sweeps "
+            "WHERE bucket = ? AND substr(?, 1, length(prefix)) = prefix",
+            (self._bucket, key),
+        ).fetchone()
+        return row[0]
+
+    def is_fresh(self, key="iiif/"):
+        """Whether key is covered by a sweep younger than max_age"""
+        listed_at = self.listed_at(key)
+        return listed_at is not None and time.time() - listed_at <= self._max_age
+
+    def ensure(self, prefix="iiif/"):
+        """Sweep prefix unless a fresh sweep already covers it"""
+        if not self.is_fresh(prefix):
+            logger.info(f"{cf.BLUE}Indexing s3://{self._bucket}/{prefix}...")
+            self.refresh(prefix)
+
+    def get(self, key):
+        """Return an object's size, etag and last_modified, or None if it doesn't exist"""
+        row = self._conn.execute(
+            "SELECT size, etag, last_modified FROM objects WHERE bucket = ? AND key = ?",
+            (self._bucket, key),
+        ).fetchone()
+        return dict(row) if row else None
+
+    def exists(self, key):
+        return self.get(key) is not None
+
+    def size(self, key):
+        obj = self.get(key)
+        return obj["size"] if obj else None
+
+    def etag(self, key):
+        obj = self.get(key)
+        return obj["etag"] if obj else None
+
+    def record(self, key, size, etag):
+        """Record an object this run uploaded, so the index stays current"""
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+                (
+                    self._bucket,
+                    key,
+                    size,
+                    etag,
+                    datetime.now(timezone.utc).isoformat(),
+                ),
+            )
+
+    def record_many(self, objects):
+        """Record objects this run uploaded, in one transaction.
+
+        Args:
+            objects: Iterable of (key, size, etag) tuples
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+                [(self._bucket, key, size, etag, now) for key, size, etag in objects],
+            )
+
+    def discard(self, key):
+        """Forget an object this run deleted"""
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM objects WHERE bucket = ? AND key = ?", (self._bucket, key)
+            )
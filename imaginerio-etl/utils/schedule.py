@@ -0,0 +1,116 @@
+import statistics
+import threading
+import time
+
+# Estimates used until past runs have recorded timings
+MANIFEST_SECONDS = 1.0  # publishing the manifest of an item that is already tiled
+DEFAULT_SECONDS_PER_MB = 2.0  # downloading, tiling and uploading a source image
+DEFAULT_SOURCE_MB = 50.0  # size of a source image that was never downloaded
+
+
+def seconds_per_byte(timings):
+    """Median tiling time per source image byte of past runs.
+
+    Args:
+        timings: List of (source_bytes, tile_seconds) tuples
+    """
+    rates = [seconds / size for size, seconds in timings if size and seconds]
+    if not rates:
+        return DEFAULT_SECONDS_PER_MB / 1024**2
+    return statistics.median(rates)
+
+
+def estimate_costs(states, tile_flags, timings=()):
+    """Estimate how many seconds each item will take to process.
+
+    An item that was tiled before is expected to take as long as it did last
+    time. Otherwise its cost is its source image size, or the median known
+    size, times the median tiling rate of past runs.
+
+    Args:
+        states: Dictionary of item id -> resolved state
+        tile_flags: Dictionary of item id -> whether the item needs tiling
+        timings: Past (source_bytes, tile_seconds), see StateStore.timings
+
+    Returns:
+        Dictionary of item id -> estimated seconds
+    """
+    rate = seconds_per_byte(timings)
+    sizes = [size for size, _ in timings if size]
+    default_bytes = statistics.median(sizes) if sizes else DEFAULT_SOURCE_MB * 1024**2
+    costs = {}
+    for id, state in states.items():
+        if not tile_flags[id]:
+            costs[id] = MANIFEST_SECONDS
+        elif state.get("tile_seconds"):
+            costs[id] = state["tile_seconds"] + MANIFEST_SECONDS
+        else:
+            size = state.get("source_bytes") or default_bytes
+            costs[id] = size * rate + MANIFEST_SECONDS
+    return costs
+
+
+def order_by_cost(ids, tile_flags, costs):
+    """Order items so the most manifests complete early.
+
+    Items that only need their manifest come first, then items to tile from
+    the cheapest to the most expensive, so the largest scans run last.
+    """
+    return sorted(ids, key=lambda id: (tile_flags[id], costs[id]))
+
+
+class InFlight:
+    """Estimated work of the items started but not finished yet.
+
+    Shared by the thread feeding a pipeline, which starts items, and the one
+    consuming it, which finishes them.
+
+    Args:
+        costs: Dictionary of item id -> estimated seconds
+        workers: Items processed at once, which share the work
+    """
+
+    def __init__(self, costs, workers=1):
+        self._costs = costs
+        self._workers = max(workers, 1)
+        self._ids = set()
+        self._lock = threading.Lock()
+
+    def start(self, id):
+        with self._lock:
+            self._ids.add(id)
+
+    def finish(self, id):
+        with self._lock:
+            self._ids.discard(id)
+
+    @property
+    def seconds(self):
+        """Estimated seconds before the started items are all done"""
+        with self._lock:
+            return sum(self._costs[id] for id in self._ids) / self._workers
+
+
+def within_deadline(ids, costs, deadline, deferred, in_flight=None):
+    """Yield ids while each one can be expected to finish before the deadline.
+
+    An item is expected to finish once the items still in flight are done,
+    plus its own cost. Once an item doesn't fit, it and every item after it,
+    which are ordered by increasing cost, are appended to deferred instead.
+
+    Args:
+        deadline: time.monotonic() value, or None for no deadline
+        deferred: List receiving the ids that weren't yielded
+        in_flight: InFlight the yielded ids are started in, None if nothing
+            else is in progress when an id is yielded
+    """
+    ids = iter(ids)
+    for id in ids:
+        pending = in_flight.seconds if in_flight is not None else 0
+        if deadline is not None and time.monotonic() + pending + costs[id] > deadline:
+            deferred.append(id)
+            deferred.extend(ids)
+            return
+        if in_flight is not None:
+            in_flight.start(id)
+        yield id
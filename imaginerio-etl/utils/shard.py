@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import re
+from collections import defaultdict
+
+from ..config import SHARDS_DIR
+from .helpers import dump_json_atomic
+
+# Summary fields merged by taking the largest value instead of the sum
+MAX_FIELDS = {"max_peak_rss", "elapsed"}
+
+
+def parse_shard(text):
+    """Parse a "i/n" shard specification, i counting from 1.
+
+    Returns:
+        Tuple of (i, n)
+    """
+    match = re.fullmatch(r"(\d+)/(\d+)", text)
+    if not match or not 1 <= int(match[1]) <= int(match[2]):
+        raise ValueError(f"Invalid shard {text!r}, expected i/n with 1 <= i <= n")
+    return int(match[1]), int(match[2])
+
+
+def shard_of(id, count):
+    """The shard, from 1 to count, an item belongs to.
+
+    Based on a hash of the id, so every runner partitions items the same way
+    whatever their order in the metadata.
+    """
+    digest = hashlib.sha256(str(id).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count + 1
+
+
+def select_shard(metadata, index, count):
+    """Rows of metadata that belong to shard index of count"""
+    return metadata.loc[[shard_of(id, count) == index for id in metadata.index]]
+
+
+class CollectionChanges:
+    """Stands in for an IndexedCollection on a shard, recording the manifest
+    references added to a collection for the finalize step to apply"""
+
+    def __init__(self):
+        self.references = {}
+        self.removed = set()
+
+    def add(self, manifest):
+        self.add_reference(manifest.to_reference())
+
+    def add_reference(self, reference):
+        self.references[reference.id] = reference.json()
+        self.removed.discard(reference.id)
+
+    def remove(self, manifest_id):
+        self.references.pop(manifest_id, None)
+        self.removed.add(manifest_id)
+
+
+class ShardArtifact:
+    """Everything a shard produced that must be published once for all shards.
+
+    Holds the shard's collection changes, item states, touched CloudFront
+    paths and summary. Each shard writes its own file, so artifacts never
+    conflict, and the finalize step merges them.
+    """
+
+    def __init__(self, index, count, directory=SHARDS_DIR):
+        self.index = index
+        self.count = count
+        self.path = os.path.join(directory, f"shard-{index}-of-{count}.json")
+        self.collections = defaultdict(CollectionChanges)
+        self.states = {}
+        self.invalidations = []
+        self.summary = {}
+
+    def save(self):
+        dump_json_atomic(
+            {
+                "index": self.index,
+                "count": self.count,
+                "collections": {
+                    label: list(changes.references.values())
+                    for label, changes in self.collections.items()
+                },
+                "removals": {
+                    label: sorted(changes.removed)
+                    for label, changes in self.collections.items()
+                    if changes.removed
+                },
+                "states": self.states,
+                "invalidations": self.invalidations,
+                "summary": self.summary,
+            },
+            self.path,
+        )
+        return self.path
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        artifact = cls(data["index"], data["count"], os.path.dirname(path))
+        for label, references in data["collections"].items():
+            for reference in references:
+                artifact.collections[label].references[json.loads(reference)["id"]] = reference
+        for label, manifest_ids in data.get("removals", {}).items():
+            artifact.collections[label].removed.update(manifest_ids)
+        artifact.states = data["states"]
+        artifact.invalidations = data["invalidations"]
+        artifact.summary = data["summary"]
+        return artifact
+
+
+def load_shards(directory=SHARDS_DIR, count=None):
+    """Load the artifacts of every shard of a run.
+
+    Args:
+        count: Expected number of shards, read from the artifacts if None
+
+    Raises:
+        ValueError: If artifacts are missing or come from runs with
+            different shard counts
+    """
+    paths = sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if re.fullmatch(r"shard-\d+-of-\d+\.json", name)
+    )
+    artifacts = [ShardArtifact.load(path) for path in paths]
+    counts = {artifact.count for artifact in artifacts} | ({count} if count else set())
+    if len(counts) != 1:
+        raise ValueError(f"Shard artifacts in {directory} have different counts: {counts}")
+    count = counts.pop()
+    missing = set(range(1, count + 1)) - {artifact.index for artifact in artifacts}
+    if missing:
+        raise ValueError(f"Missing artifacts of shards {sorted(missing)} of {count}")
+    return artifacts
+
+
+def merge_summaries(summaries):
+    """Combine shard summaries: counts are summed and lists concatenated"""
+    merged = {}
+    for summary in summaries:
+        for key, value in summary.items():
+            if isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            elif key in MAX_FIELDS:
+                merged[key] = max(merged.get(key, 0), value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
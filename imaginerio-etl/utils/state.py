@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+from ..config import STATE_DB
+
+# Column name -> SQLite type. New columns are added to existing stores on open.
+COLUMNS = {
+    "sizes": "TEXT",  # JSON list of {"width", "height"}, smallest first
+    "source_hash": "TEXT",  # SHA-256 of the source image
+    "source_etag": "TEXT",  # validators of the source image's last download
+    "source_last_modified": "TEXT",
+    "source_bytes": "INTEGER",
+    "tile_seconds": "REAL",  # time spent downloading, tiling and uploading the image
+    "manifest_hash": "TEXT",  # SHA-256 of the published manifest
+    "processed_at": "TEXT",  # ISO 8601, UTC
+}
+JSON_COLUMNS = {"sizes"}
+
+
+def canonical_json(json_text):
+    """Serialize JSON text canonically: sorted keys, no whitespace, UTF-8"""
+    return json.dumps(
+        json.loads(json_text), sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    ).encode("utf-8")
+
+
+def hash_manifest(manifest_json):
+    """SHA-256 hex digest of a manifest's canonical serialization.
+
+    Formatting and key order don't affect the hash, so a manifest read back
+    from S3 hashes the same as the one that was generated.
+    """
+    return hashlib.sha256(canonical_json(manifest_json)).hexdigest()
+
+
+class StateStore:
+    """Per-item pipeline state, persisted in a SQLite file next to the data.
+
+    Lets a run know what previous runs produced (image sizes, hashes) without
+    asking CloudFront or S3. Only use a store from the thread that opened it.
+    """
+
+    def __init__(self, path=STATE_DB):
+        self._path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY)")
+        existing = {row["name"] for row in self._conn.execute("PRAGMA table_info(items)")}
+        for name, type in COLUMNS.items():
+            if name not in existing:
+                self._conn.execute(f"ALTER TABLE items ADD COLUMN {name} {type}")
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def get(self, id):
+        """Return the stored state of an item as a dictionary, or None if unknown"""
+        row = self._conn.execute("SELECT * FROM items WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return None
+        state = dict(row)
+        for name in JSON_COLUMNS:
+            if state[name] is not None:
+                state[name] = json.loads(state[name])
+        return state
+
+    def get_sizes(self, id):
+        state = self.get(id)
+        return state["sizes"] if state else None
+
+    def update(self, id, commit=True, **fields):
+        """Insert or update an item's state, stamping processed_at.
+
+        Args:
+            id: Item identifier
+            commit: Set to False when batching many updates, then call commit()
+            **fields: Column values to set, other columns are left untouched
+        """
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown state fields: {sorted(unknown)}")
+        fields.setdefault("processed_at", datetime.now(timezone.utc).isoformat())
+        for name in JSON_COLUMNS & set(fields):
+            if fields[name] is not None:
+                fields[name] = json.dumps(fields[name])
+        names = list(fields)
+        self._conn.execute(
+            f"INSERT INTO items (id, {', '.join(names)}) "
+            f"VALUES (?, {', '.join('?' for _ in names)}) "
+            f"ON CONFLICT(id) DO UPDATE SET "
+            f"{', '.join(f'{name} = excluded.{name}' for name in names)}",
+            [id, *fields.values()],
+        )
+        if commit:
+            self.commit()
+
+    def timings(self):
+        """Source image size and tiling time of every item tiled so far.
+
+        Returns:
+            List of (source_bytes, tile_seconds) tuples
+        """
+        return [
+            tuple(row)
+            for row in self._conn.execute(
+                "SELECT source_bytes, tile_seconds FROM items "
+                "WHERE source_bytes IS NOT NULL AND tile_seconds IS NOT NULL"
+            )
+        ]
+
+    def commit(self):
+        self._conn.commit()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import threading
+
+from ..config import WORKSPACE, WORKSPACE_BUDGET
+from .logger import CustomFormatter as cf
+from .logger import logger
+from .pipeline import Cancelled
+
+# Rough upper bound of an item's tile tree size (tiles, derivatives and the
+# source image) relative to its source image, used until the tree is measured
+EXPANSION = 3
+
+
+def tree_size(path):
+    """Total size in bytes of the files under path"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except FileNotFoundError:
+                continue
+    return total
+
+
+class Workspace:
+    """Local item trees under iiif/ in root, kept within a disk budget.
+
+    Space is reserved before an item is tiled and released once its tree has
+    been uploaded and removed. reserve blocks while the budget is used up,
+    which pauses tiling until uploads catch up. An item is always let through
+    when nothing else holds space, so one image larger than the budget can't
+    stall a run. Safe to use from several threads.
+
+    Args:
+        root: Directory holding the trees, e.g. on a tmpfs such as /dev/shm
+        budget: Maximum bytes reserved at once, 0 for no limit
+    """
+
+    def __init__(self, root=WORKSPACE, budget=WORKSPACE_BUDGET):
+        self.root = root
+        self._budget = budget
+        self._reserved = {}
+        self._condition = threading.Condition()
+
+    @property
+    def used(self):
+        """Bytes currently reserved"""
+        with self._condition:
+            return sum(self._reserved.values())
+
+    def path(self, id):
+        return os.path.join(self.root, "iiif", id)
+
+    def reserve(self, id, cancelled=None):
+        """Reserve space to tile an item, blocking until it fits in the budget.
+
+        The reservation is estimated from the item's tree as downloaded, then
+        corrected by measure once it's tiled.
+
+        Args:
+            cancelled: threading.Event that stops the wait when set
+
+        Raises:
+            Cancelled: If cancelled was set before the item fit
+        """
+        estimate = tree_size(self.path(id)) * EXPANSION
+        with self._condition:
+            if self._budget and not self._fits(estimate):
+                logger.info(
+                    f"{cf.YELLOW}Workspace budget reached, item {id} waits for "
+                    f"uploads to free space{cf.RESET}"
+                )
+                while not self._condition.wait_for(lambda: self._fits(estimate), timeout=0.1):
+                    if cancelled is not None and cancelled.is_set():
+                        raise Cancelled(f"Cancelled while item {id} waited for space")
+            self._reserved[id] = estimate
+
+    def _fits(self, nbytes):
+        used = sum(self._reserved.values())
+        return not used or used + nbytes <= self._budget
+
+    def measure(self, id):
+        """Replace an item's estimated reservation with its tree's actual size"""
+        size = tree_size(self.path(id))
+        with self._condition:
+            self._reserved[id] = size
+            self._condition.notify_all()
+
+    def release(self, id):
+        """Remove an item's tree and free the space reserved for it"""
+        shutil.rmtree(self.path(id), ignore_errors=True)
+        with self._condition:
+            self._reserved.pop(id, None)
+            self._condition.notify_all()
@@ -2,6 +2,9 @@
 
 import pytest
 import pandas as pd
+from moto import mock_aws
+
+from imaginerio_etl.utils import helpers
 
 
 @pytest.fixture
@@ -51,4 +54,16 @@ def sample_metadata_row():
         "Smapshot ID": "S123",
         "Collection": "Test Collection",
         "Media URL": "https://test.com/media"
-    } 
\ No newline at end of file
+    } 
+
+@pytest.fixture
+def s3(monkeypatch):
+    """Moto-backed S3 client with an empty images bucket."""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = helpers.create_s3_client()
+        client.create_bucket(Bucket=helpers.BUCKET_NAME)
+        monkeypatch.setattr(helpers, "s3_client", client)
+        yield client
@@ -0,0 +1,56 @@
+"""Tests for the source image download cache."""
+
+import hashlib
+import os
+
+import pytest
+
+from imaginerio_etl.utils.cache import DownloadCache
+
+
+URL = "https://test.com/media"
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DownloadCache(str(tmp_path / "cache"), max_bytes=2500)
+
+
+def test_get_returns_cached_image(cache, tmp_path):
+    digest = write(str(tmp_path / "image.jpg"), b"a" * 1000)
+    cache.put(URL, '"v1"', str(tmp_path / "image.jpg"), digest)
+
+    destination = str(tmp_path / "out" / "default.jpg")
+    assert cache.get(URL, '"v1"', destination) == digest
+    with open(destination, "rb") as f:
+        assert f.read() == b"a" * 1000
+
+
+def test_changed_validator_misses(cache, tmp_path):
+    digest = write(str(tmp_path / "image.jpg"), b"a" * 1000)
+    cache.put(URL, '"v1"', str(tmp_path / "image.jpg"), digest)
+
+    assert cache.get(URL, '"v2"', str(tmp_path / "out.jpg")) is None
+    assert cache.get("https://test.com/other", '"v1"', str(tmp_path / "out.jpg")) is None
+
+
+def test_evicts_least_recently_used(cache, tmp_path):
+    for n, name in enumerate(["a", "b", "c"]):
+        path = str(tmp_path / f"{name}.jpg")
+        digest = write(path, name.encode() * 1000)
+        os.utime(path, (n, n))  # a is the oldest
+        cache.put(f"{URL}/{name}", '"v1"', path, digest)
+        if name == "b":
+            # Touch a, making b the least recently used
+            cache.get(f"{URL}/a", '"v1"', str(tmp_path / "out.jpg"))
+
+    assert cache.get(f"{URL}/b", '"v1"', str(tmp_path / "out.jpg")) is None
+    assert cache.get(f"{URL}/a", '"v1"', str(tmp_path / "out.jpg"))
+    assert cache.get(f"{URL}/c", '"v1"', str(tmp_path / "out.jpg"))
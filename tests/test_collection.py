@@ -0,0 +1,55 @@
+"""Tests for the IndexedCollection class."""
+
+import json
+
+import pytest
+from iiif_prezi3 import Collection, Manifest
+
+from imaginerio_etl.entities.collection import IndexedCollection
+from imaginerio_etl.utils.helpers import create_collection
+
+
+def make_manifest(id, label="Test"):
+    return Manifest(id=f"https://test.com/{id}/manifest.json", label=label)
+
+
+@pytest.fixture
+def collection():
+    collection = create_collection("Views")
+    for id in ["A", "B", "C"]:
+        collection.add_item_by_reference(make_manifest(id))
+    # Round trip through JSON, as collections are loaded from CloudFront
+    return IndexedCollection(Collection(**json.loads(collection.json())))
+
+
+def ids(collection):
+    return [ref.id.split("/")[-2] for ref in collection]
+
+
+def test_loaded_collection_is_clean(collection):
+    assert len(collection) == 3
+    assert not collection.dirty
+
+
+def test_add_identical_manifest_keeps_collection_clean(collection):
+    collection.add(make_manifest("B"))
+    assert not collection.dirty
+
+
+def test_replace_keeps_position(collection):
+    collection.add(make_manifest("B", label="New label"))
+
+    assert collection.dirty
+    assert ids(collection) == ["A", "B", "C"]
+    assert str(collection.build().items[1].label) != str(collection.build().items[0].label)
+
+
+def test_add_and_remove(collection):
+    collection.add(make_manifest("D"))
+    collection.remove("https://test.com/A/manifest.json")
+    collection.remove("https://test.com/missing/manifest.json")
+
+    assert collection.dirty
+    assert ids(collection) == ["B", "C", "D"]
+    assert "https://test.com/D/manifest.json" in collection
+    assert [ref.id for ref in collection.build().items] == [ref.id for ref in collection]
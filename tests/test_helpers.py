@@ -0,0 +1,242 @@
+"""Tests for helper functions."""
+
+import os
+
+import pandas as pd
+import pytest
+import requests
+import responses
+from boto3.s3.transfer import TransferConfig
+
+from imaginerio_etl.utils import helpers
+
+
+@pytest.fixture
+def tile_tree(tmp_path, monkeypatch):
+    """Small IIIF tile tree under iiif/TEST001, relative to the cwd."""
+    monkeypatch.chdir(tmp_path)
+    paths = ["iiif/TEST001/info.json"]
+    for x in range(4):
+        for y in range(4):
+            paths.append(f"iiif/TEST001/{x * 256},{y * 256},256,256/256,/0/default.jpg")
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(os.urandom(1024))
+    return paths
+
+
+def test_upload_folder_to_s3(s3, tile_tree):
+    """Every file is uploaded under its relative path with a content type."""
+    results = helpers.upload_folder_to_s3("iiif/TEST001", threads=4)
+
+    assert results == {os.path.join(*path.split("/")): True for path in tile_tree}
+    keys = {
+        obj["Key"]
+        for obj in s3.list_objects_v2(Bucket=helpers.BUCKET_NAME)["Contents"]
+    }
+    assert keys == set(tile_tree)
+    head = s3.head_object(Bucket=helpers.BUCKET_NAME, Key="iiif/TEST001/info.json")
+    assert head["ContentType"] == "application/json"
+
+
+def test_upload_files_to_s3_reports_failures(s3, tile_tree):
+    """Missing files are reported as failed instead of aborting the batch."""
+    results = helpers.upload_files_to_s3(tile_tree[:3] + ["iiif/TEST001/missing.jpg"])
+
+    assert results["iiif/TEST001/missing.jpg"] is False
+    assert all(results[path] for path in tile_tree[:3])
+
+
+@responses.activate
+def test_prefetch_sizes():
+    """Tiled, untiled and unreachable items are told apart."""
+    sizes = [{"width": 100, "height": 50}]
+    responses.get(f"{helpers.CLOUDFRONT}/TILED/info.json", json={"sizes": sizes})
+    responses.get(f"{helpers.CLOUDFRONT}/UNTILED/info.json", body="<Error/>", status=403)
+    responses.get(
+        f"{helpers.CLOUDFRONT}/DOWN/info.json", body=requests.ConnectionError("down")
+    )
+
+    result = helpers.prefetch_sizes(["TILED", "UNTILED", "DOWN"], threads=3)
+
+    assert result == {"TILED": sizes, "UNTILED": None}
+
+
+@responses.activate
+def test_prefetch_sizes_leaves_out_malformed_info():
+    """An info.json without sizes only fails its own item."""
+    sizes = [{"width": 100, "height": 50}]
+    responses.get(f"{helpers.CLOUDFRONT}/TILED/info.json", json={"sizes": sizes})
+    responses.get(f"{helpers.CLOUDFRONT}/NOSIZES/info.json", json={"id": "x"})
+    responses.get(f"{helpers.CLOUDFRONT}/LIST/info.json", json=[1, 2])
+
+    result = helpers.prefetch_sizes(["TILED", "NOSIZES", "LIST"], threads=3)
+
+    assert result == {"TILED": sizes}
+
+
+@responses.activate
+def test_fetch_collection_revalidates_cache(tmp_path):
+    """The cached copy is used when CloudFront answers 304 Not Modified."""
+    url = f"{helpers.CLOUDFRONT}/collection/views.json"
+    collection = {"id": url, "type": "Collection", "label": {"none": ["Views"]}}
+    responses.get(url, json=collection, headers={"ETag": '"v1"'})
+    assert helpers.fetch_collection("Views", str(tmp_path)) == collection
+
+    responses.replace(
+        responses.GET,
+        url,
+        status=304,
+        match=[responses.matchers.header_matcher({"If-None-Match": '"v1"'})],
+    )
+    assert helpers.fetch_collection("Views", str(tmp_path)) == collection
+
+
+@responses.activate
+def test_get_collections_parses_lazily():
+    """Collections are fetched upfront but only parsed when accessed."""
+    responses.get(f"{helpers.CLOUDFRONT}/collection/views.json", status=403)
+    responses.get(f"{helpers.CLOUDFRONT}/collection/maps.json", status=403)
+    metadata = pd.DataFrame([{"Collection": "Views|Maps"}, {"Collection": None}])
+
+    collections = helpers.get_collections(metadata)
+
+    assert sorted(collections) == ["Maps", "Views"]
+    assert collections.loaded() == {}
+    assert collections["Views"].id.endswith("/collection/views.json")
+    assert list(collections.loaded()) == ["Views"]
+
+
+def test_upload_files_to_s3_keys_relative_to_root(s3, tile_tree, tmp_path):
+    """Files in a workspace outside the cwd are keyed from the workspace root."""
+    paths = [str(tmp_path / path) for path in tile_tree[:2]]
+    helpers.upload_files_to_s3(paths, root=str(tmp_path))
+
+    keys = {
+        obj["Key"]
+        for obj in s3.list_objects_v2(Bucket=helpers.BUCKET_NAME)["Contents"]
+    }
+    assert keys == set(tile_tree[:2])
+
+
+def test_sync_folder_to_s3_uploads_only_changes(s3, tile_tree):
+    """Unchanged files are skipped and orphans deleted, except excluded keys."""
+    helpers.upload_folder_to_s3("iiif/TEST001")
+    for key in ["iiif/TEST001/0,0,512,512/256,/0/default.jpg", "iiif/TEST001/manifest.json"]:
+        s3.put_object(Bucket=helpers.BUCKET_NAME, Key=key, Body=b"old")
+    with open(tile_tree[1], "wb") as f:
+        f.write(b"changed")
+
+    stats = helpers.sync_folder_to_s3(
+        "iiif/TEST001", delete=True, exclude={"iiif/TEST001/manifest.json"}
+    )
+
+    assert stats["uploaded"] == 1
+    assert stats["skipped"] == len(tile_tree) - 1
+    assert stats["bytes_skipped"] == 1024 * (len(tile_tree) - 1)
+    assert stats["deleted"] == 1
+    keys = {
+        obj["Key"]
+        for obj in s3.list_objects_v2(Bucket=helpers.BUCKET_NAME)["Contents"]
+    }
+    assert keys == set(tile_tree) | {"iiif/TEST001/manifest.json"}
+    body = s3.get_object(Bucket=helpers.BUCKET_NAME, Key=tile_tree[1])["Body"].read()
+    assert body == b"changed"
+
+
+def test_local_etag_matches_multipart_uploads(s3, tmp_path):
+    config = TransferConfig(
+        multipart_threshold=5 * 1024**2, multipart_chunksize=5 * 1024**2, use_threads=False
+    )
+    path = tmp_path / "large.jpg"
+    path.write_bytes(os.urandom(11 * 1024**2))
+    s3.upload_file(str(path), helpers.BUCKET_NAME, "large.jpg", Config=config)
+
+    etag = s3.head_object(Bucket=helpers.BUCKET_NAME, Key="large.jpg")["ETag"].strip('"')
+    assert helpers.local_etag(str(path), config) == etag
+
+
+def test_upload_files_to_s3_routes_large_files_to_multipart(s3, tile_tree, tmp_path):
+    """Large files are uploaded in parts, and sync recognizes them afterwards."""
+    large_config = TransferConfig(
+        multipart_threshold=5 * 1024**2, multipart_chunksize=5 * 1024**2, max_concurrency=4
+    )
+    large = "iiif/TEST001/full/max/0/default.jpg"
+    os.makedirs(os.path.dirname(large))
+    with open(large, "wb") as f:
+        f.write(os.urandom(11 * 1024**2))
+
+    results = helpers.upload_files_to_s3([large, tile_tree[0]], large_config=large_config)
+
+    assert all(results.values())
+    etag = s3.head_object(Bucket=helpers.BUCKET_NAME, Key=large)["ETag"].strip('"')
+    assert etag.endswith("-3")
+    assert helpers.local_etag(large, large_config) == etag
+
+
+
+def test_get_metadata_changes_persists_hashes(tmp_path):
+    """The first run compares with the current file, later ones with saved hashes."""
+    current_file = str(tmp_path / "current.xlsx")
+    new_file = str(tmp_path / "new.xlsx")
+    hashes_path = str(tmp_path / "hashes.db")
+    export = pd.DataFrame(
+        {
+            "SSID": ["A", "B", "C"],
+            "Title": ["a", "b", "c"],
+            "Collection": ["Views", "Maps", "Maps"],
+            "Status": "In imagineRio",
+            "Notes": "",
+        }
+    )
+    export.drop(columns="Notes").to_excel(current_file, index=False)
+    export.loc[0, "Title"] = "a2"
+    export.loc[2, "Status"] = "Draft"
+    export.to_excel(new_file, index=False)
+
+    _, changed_data, changes, removed = helpers.get_metadata_changes(
+        current_file, new_file, hashes_path
+    )
+
+    assert list(changed_data.index) == ["A"]
+    assert changes == {"A": {"Title": None}}
+    assert removed["Collection"].to_dict() == {"C": "Maps"}
+
+    os.remove(current_file)  # hashes of the last run are enough from now on
+    export.loc[1, "Collection"] = "Views"
+    export.loc[2, "Status"] = "In imagineRio"
+    export.to_excel(new_file, index=False)
+
+    _, changed_data, changes, removed = helpers.get_metadata_changes(
+        current_file, new_file, hashes_path
+    )
+
+    assert changes == {"B": {"Collection": "Maps"}, "C": {"Status": None}}
+    assert removed.empty
+
+
+def test_get_metadata_changes_reprocess_keeps_collection_moves(tmp_path, monkeypatch):
+    """Reprocessing routes every item in full but remembers where it was."""
+    current_file = str(tmp_path / "current.xlsx")
+    new_file = str(tmp_path / "new.xlsx")
+    export = pd.DataFrame(
+        {
+            "SSID": ["A", "B"],
+            "Title": ["a", "b"],
+            "Collection": ["Views", "Maps"],
+            "Status": "In imagineRio",
+            "Notes": "",
+        }
+    )
+    export.drop(columns="Notes").to_excel(current_file, index=False)
+    export.loc[1, "Collection"] = "Views"
+    export.to_excel(new_file, index=False)
+    monkeypatch.setattr(helpers, "REPROCESS", "true")
+
+    _, changed_data, changes, _ = helpers.get_metadata_changes(
+        current_file, new_file, str(tmp_path / "hashes.db")
+    )
+
+    assert list(changed_data.index) == ["A", "B"]
+    assert changes == {"A": {"Status": None}, "B": {"Collection": "Maps", "Status": None}}
@@ -0,0 +1,374 @@
+"""Tests for the IIIF update script."""
+
+import hashlib
+import os
+import time
+
+import pandas as pd
+import pytest
+import responses
+from iiif_prezi3 import ManifestRef
+from PIL import Image
+
+from imaginerio_etl.entities.collection import LazyCollections
+from imaginerio_etl.entities.item import Item, NotModified, pyvips
+from imaginerio_etl.scripts import iiif
+from imaginerio_etl.utils.helpers import create_collection
+from imaginerio_etl.utils.journal import Journal
+from imaginerio_etl.utils.state import COLUMNS, StateStore
+
+
+SIZES = [{"width": 100, "height": 50}, {"width": 1600, "height": 800}]
+
+
+@pytest.fixture
+def metadata(sample_metadata_row):
+    rows = {}
+    for n in range(6):
+        row = dict(sample_metadata_row, Collection="Views")
+        rows[f"ITEM{n}"] = row
+    rows["BROKEN"] = dict(sample_metadata_row, Collection="Views")
+    return pd.DataFrame.from_dict(rows, orient="index")
+
+
+@pytest.fixture
+def patched(monkeypatch, sample_vocabulary, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    uploads = []
+
+    def get_sizes(self):
+        if self._id == "BROKEN":
+            raise ValueError("broken item")
+        return SIZES
+
+    monkeypatch.setattr(Item, "get_sizes", get_sizes)
+    monkeypatch.setattr(
+        iiif, "prefetch_sizes", lambda ids: {id: SIZES for id in ids if id != "BROKEN"}
+    )
+    monkeypatch.setattr(iiif, "get_vocabulary", lambda path: sample_vocabulary)
+    monkeypatch.setattr(
+        iiif,
+        "get_collections",
+        lambda metadata, extra_labels=(): LazyCollections({"Views": None}, create_collection),
+    )
+    monkeypatch.setattr(
+        iiif, "upload_object_to_s3", lambda obj, name, key: uploads.append(key) or True
+    )
+    monkeypatch.setattr(iiif, "get_etag", lambda key: None)
+    monkeypatch.setattr(iiif.S3Index, "head_many", lambda self, keys: 0)
+    return uploads
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_update_reports_errors_and_manifests(metadata, patched, workers):
+    """Serial and parallel modes report the same per-item results."""
+    result = iiif.update(metadata, workers=workers)
+
+    assert result["n_items"] == 7
+    assert result["n_manifests"] == 6
+    assert result["errors"] == ["BROKEN"]
+    assert result["n_published"] == 6
+    assert result["elapsed"] > 0
+    assert "iiif/collection/views.json" in patched
+
+
+@pytest.mark.parametrize(
+    "recorded_hash, force, tiled",
+    [("abc", False, False), ("abc", True, True), ("old", False, True)],
+)
+def test_process_item_skips_unchanged_images(
+    monkeypatch, sample_metadata_row, sample_vocabulary, recorded_hash, force, tiled
+):
+    """Retiling is skipped when the source image hash matches, unless forced."""
+    tile_calls = []
+    monkeypatch.setattr(iiif, "RETILE", "true")
+    monkeypatch.setattr(Item, "get_sizes", lambda self: SIZES)
+    monkeypatch.setattr(Item, "download_image", lambda self, **kwargs: "abc")
+    monkeypatch.setattr(
+        Item, "tile_image", lambda self, download: tile_calls.append(self._id) or SIZES
+    )
+
+    result = iiif.process_item(
+        "TEST001", sample_metadata_row, sample_vocabulary,
+        force=force, state={"source_hash": recorded_hash},
+    )
+
+    assert result["sizes"] == SIZES
+    assert result["source_hash"] == "abc"
+    assert result["peak_rss"] > 0
+    assert bool(tile_calls) == tiled
+
+
+def test_publish_manifest_skips_unchanged(monkeypatch):
+    """Manifests matching the stored hash or the remote ETag aren't uploaded."""
+    uploads = []
+    monkeypatch.setattr(
+        iiif, "upload_object_to_s3", lambda obj, name, key: uploads.append(key) or True
+    )
+    manifest_json = '{"id": "m", "label": "Test"}'
+    reformatted = '{\n    "label": "Test",\n    "id": "m"\n}'
+    etag = hashlib.md5(manifest_json.encode()).hexdigest()
+    monkeypatch.setattr(iiif, "get_etag", lambda key: etag)
+
+    published, manifest_hash = iiif.publish_manifest("TEST001", manifest_json)
+    assert not published
+    assert iiif.publish_manifest("TEST001", reformatted, manifest_hash) == (
+        False,
+        manifest_hash,
+    )
+    assert iiif.publish_manifest("TEST001", '{"id": "m"}', manifest_hash)[0]
+    assert uploads == ["iiif/TEST001/manifest.json"]
+
+
+def test_process_item_skips_not_modified_images(
+    monkeypatch, sample_metadata_row, sample_vocabulary
+):
+    """Stored validators are sent, and a 304 skips download and tiling."""
+    requests = []
+
+    def download_image(self, etag=None, last_modified=None):
+        requests.append((etag, last_modified))
+        raise NotModified()
+
+    monkeypatch.setattr(iiif, "RETILE", "true")
+    monkeypatch.setattr(Item, "download_image", download_image)
+    state = {"sizes": SIZES, "source_hash": "abc", "source_etag": '"v1"'}
+
+    result = iiif.process_item("TEST001", sample_metadata_row, sample_vocabulary, state=state)
+
+    assert result["not_modified"]
+    assert result["sizes"] == SIZES
+    assert result["source_hash"] == "abc"
+    assert requests == [('"v1"', None)]
+
+
+@responses.activate
+def test_fetch_source_stores_validators_of_the_download(
+    monkeypatch, sample_metadata_row, sample_vocabulary, tmp_path
+):
+    """Validators of a plain GET make the next retile a conditional request."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(iiif, "RETILE", "true")
+    item = Item("TEST001", sample_metadata_row, sample_vocabulary)
+    validators = {"ETag": '"v1"', "Last-Modified": "Wed, 01 Jan 2025 00:00:00 GMT"}
+    responses.get(item._jstor_img_path, body=b"image", headers=validators)
+    responses.head(
+        item._jstor_img_path,
+        status=304,
+        match=[
+            responses.matchers.header_matcher(
+                {
+                    "If-None-Match": validators["ETag"],
+                    "If-Modified-Since": validators["Last-Modified"],
+                }
+            )
+        ],
+    )
+
+    with StateStore(str(tmp_path / "state.db")) as store:
+        result = iiif.fetch_source(item, {"sizes": SIZES})
+        assert result["tile"]
+        store.update("TEST001", **{field: result[field] for field in COLUMNS if field in result})
+        state = store.get("TEST001")
+    item = Item("TEST001", sample_metadata_row, sample_vocabulary)
+    result = iiif.fetch_source(item, state)
+
+    assert result["not_modified"]
+    assert [call.request.method for call in responses.calls] == ["GET", "HEAD"]
+
+
+def test_find_stale_items(metadata, patched, monkeypatch):
+    """Only items whose probed dimensions differ from their tiles are stale."""
+    metadata["Media URL"] = [f"https://example.com/{id}.jpg" for id in metadata.index]
+
+    def probe(url):
+        if "ITEM1" in url:
+            return (1200, 800)
+        if "ITEM2" in url:
+            raise ValueError("not a JPEG")
+        return (1600, 800)
+
+    monkeypatch.setattr(iiif, "probe_image_size", probe)
+    with iiif.StateStore() as store:
+        assert iiif.find_stale_items(metadata, store, threads=2) == ["ITEM1"]
+
+
+def test_update_pipeline_tiles_uploads_and_cleans_up(metadata, patched, monkeypatch):
+    """Retiled items go through every stage and their tile trees are removed."""
+    uploaded = []
+    monkeypatch.setattr(iiif, "RETILE", "true")
+    monkeypatch.setattr(Item, "download_image", lambda self, **kwargs: "abc")
+
+    def tile_image(self, download, upload):
+        os.makedirs(f"iiif/{self._id}/full", exist_ok=True)
+        return SIZES
+
+    monkeypatch.setattr(Item, "tile_image", tile_image)
+    monkeypatch.setattr(
+        Item, "upload_tiles", lambda self, **kwargs: uploaded.append(self._id) or {}
+    )
+
+    result = iiif.update(metadata.drop(index="BROKEN"), workers=1)
+
+    assert result["errors"] == []
+    assert sorted(uploaded) == [f"ITEM{n}" for n in range(6)]
+    assert not any(os.path.exists(f"iiif/ITEM{n}") for n in range(6))
+
+
+def test_update_resumes_from_checkpoint(metadata, patched, monkeypatch):
+    """An interrupted run's done items are skipped and its collection changes kept."""
+    metadata = metadata.drop(index="BROKEN")
+    uploads = {}
+
+    def upload(obj, name, key):
+        manifests = [key for key in uploads if key.endswith("manifest.json")]
+        if key.endswith("manifest.json") and len(manifests) == 3 and not resumed:
+            raise KeyboardInterrupt
+        uploads.setdefault(key, []).append(obj)
+        return True
+
+    resumed = False
+    monkeypatch.setattr(iiif, "upload_object_to_s3", upload)
+    with Journal() as journal:
+        with pytest.raises(KeyboardInterrupt):
+            iiif.update(metadata, journal=journal, flush_every=2)
+        pending = journal.pending()
+        done = [id for id in metadata.index if id not in pending]
+        assert len(done) == 3
+        # the first two items were flushed with the collection, not the third
+        unflushed = [id for id in done if id in journal.collection_changes()["Views"][0]]
+        assert len(unflushed) == 1
+
+        uploads.clear()
+        resumed = True
+        result = iiif.update(metadata.loc[pending], journal=journal, resume=True)
+
+        assert not journal.active()
+    assert result["errors"] == []
+    assert not any(f"iiif/{id}/manifest.json" in uploads for id in done)
+    collection = uploads["iiif/collection/views.json"][-1]
+    assert all(f"/{id}/" in collection for id in pending + unflushed)
+
+
+def test_update_defers_items_past_the_deadline(metadata, patched, monkeypatch):
+    """Items that can't finish in time stay pending in the journal."""
+    monkeypatch.setattr(iiif, "RETILE", "true")
+    metadata = metadata.drop(index="BROKEN")
+    with Journal() as journal:
+        result = iiif.update(metadata, journal=journal, deadline=time.monotonic())
+
+        assert sorted(result["deferred"]) == sorted(metadata.index)
+        assert result["n_manifests"] == 0
+        assert sorted(journal.pending()) == sorted(metadata.index)
+
+
+def test_update_routes_items_by_changed_columns(metadata, patched, monkeypatch):
+    """Only changed sources are retiled, collection moves skip the manifest."""
+    downloads = []
+    collections = LazyCollections({"Views": None, "Maps": None}, create_collection)
+    monkeypatch.setattr(iiif, "get_collections", lambda metadata, extra_labels=(): collections)
+    monkeypatch.setattr(
+        Item, "download_image", lambda self, **kwargs: downloads.append(self._id) or "abc"
+    )
+    monkeypatch.setattr(Item, "tile_image", lambda self, download, upload: SIZES)
+    monkeypatch.setattr(Item, "upload_tiles", lambda self, **kwargs: {})
+    metadata = metadata.drop(index="BROKEN")
+    for id in ["ITEM3", "OLD"]:
+        collections["Maps"].add_reference(ManifestRef(id=iiif.manifest_id(id), label={}))
+    changes = {
+        "ITEM0": {"Media URL": "https://example.com/old.jpg"},
+        "ITEM1": {"Title": "Old title"},
+        "ITEM2": {"Status": None},
+        "ITEM3": {"Collection": "Maps"},
+    }
+    removed = pd.DataFrame({"Collection": ["Maps"]}, index=["OLD"])
+
+    result = iiif.update(metadata.loc[list(changes)], changes=changes, removed=removed)
+
+    assert result["errors"] == []
+    assert downloads == ["ITEM0"]
+    assert "iiif/ITEM3/manifest.json" not in patched
+    assert result["n_membership"] == 1
+    assert result["n_removed"] == 1
+    assert len(collections["Maps"]) == 0
+    assert iiif.manifest_id("ITEM3") in collections["Views"]
+
+
+def test_resumed_run_routes_pending_items_by_recorded_changes(metadata, patched, monkeypatch):
+    """Deferred items keep their changes, which the metadata diff won't report again."""
+    downloads = []
+    collections = LazyCollections({"Views": None, "Maps": None}, create_collection)
+    monkeypatch.setattr(iiif, "get_collections", lambda metadata, extra_labels=(): collections)
+    monkeypatch.setattr(
+        Item, "download_image", lambda self, **kwargs: downloads.append(self._id) or "abc"
+    )
+    monkeypatch.setattr(Item, "tile_image", lambda self, download, upload: SIZES)
+    monkeypatch.setattr(Item, "upload_tiles", lambda self, **kwargs: {})
+    collections["Maps"].add_reference(ManifestRef(id=iiif.manifest_id("ITEM1"), label={}))
+    changes = {
+        "ITEM0": {"Media URL": "https://example.com/old.jpg"},
+        "ITEM1": {"Collection": "Maps", "Title": "Old title"},
+    }
+    metadata = metadata.loc[list(changes)]
+    with Journal() as journal:
+        result = iiif.update(
+            metadata, journal=journal, changes=changes, deadline=time.monotonic()
+        )
+        assert sorted(result["deferred"]) == ["ITEM0", "ITEM1"]
+
+        result = iiif.update(metadata.loc[journal.pending()], journal=journal, resume=True)
+
+    assert result["errors"] == []
+    assert downloads == ["ITEM0"]
+    assert len(collections["Maps"]) == 0
+    assert iiif.manifest_id("ITEM1") in collections["Views"]
+
+
+@pytest.mark.skipif(pyvips is None, reason="pyvips not available")
+def test_update_tiles_in_worker_processes(metadata, patched, monkeypatch):
+    """Sources are tiled by the process pool, and their sizes come back."""
+    # Read by the workers when they import the package, as no patch reaches them
+    monkeypatch.setenv("TILER", "pyvips")
+    monkeypatch.setattr(iiif, "RETILE", "true")
+
+    def download_image(self, **kwargs):
+        os.makedirs(os.path.dirname(self._local_img_path), exist_ok=True)
+        Image.new("RGB", (1003, 517), "red").save(self._local_img_path)
+        return self._id
+
+    monkeypatch.setattr(Item, "download_image", download_image)
+    monkeypatch.setattr(Item, "upload_tiles", lambda self, **kwargs: {})
+    metadata = metadata.loc[["ITEM0", "ITEM1"]]
+
+    result = iiif.update(metadata, workers=2)
+
+    assert result["errors"] == []
+    assert result["max_peak_rss"] > 0
+    with StateStore() as store:
+        for id in metadata.index:
+            state = store.get(id)
+            assert state["sizes"][-1] == {"width": 1003, "height": 517}
+            assert state["tile_seconds"] > 0
+
+
+def test_tiling_workers_are_not_forked():
+    """Workers start while stage threads may hold locks, so they must not fork."""
+    assert iiif._worker_context().get_start_method() in ("forkserver", "spawn")
+
+
+def test_update_pipeline_cleans_up_failed_downloads(metadata, patched, monkeypatch):
+    """A download that fails leaves no partial tree behind."""
+    monkeypatch.setattr(iiif, "RETILE", "true")
+
+    def download_image(self, **kwargs):
+        os.makedirs(f"iiif/{self._id}/full/max/0", exist_ok=True)
+        with open(f"iiif/{self._id}/full/max/0/default.jpg.part", "wb") as f:
+            f.write(b"partial")
+        raise IOError("connection reset")
+
+    monkeypatch.setattr(Item, "download_image", download_image)
+
+    result = iiif.update(metadata.drop(index="BROKEN"), workers=1)
+
+    assert len(result["errors"]) == 6
+    assert not any(os.path.exists(f"iiif/ITEM{n}") for n in range(6))
@@ -0,0 +1,109 @@
+"""Tests for CloudFront invalidation batching."""
+
+import boto3
+import botocore.waiter
+from moto import mock_aws
+
+from imaginerio_etl.utils.invalidation import Invalidations, batch_paths, collapse_paths
+
+
+def test_collapse_paths_uses_wildcards_when_cheaper():
+    paths = collapse_paths(
+        [
+            "/iiif/A/manifest.json",
+            "/iiif/A/info.json",
+            "/iiif/B/manifest.json",
+            "/iiif/C/*",
+            "/iiif/C/manifest.json",
+            "/iiif/collection/views.json",
+        ]
+    )
+
+    assert paths == [
+        "/iiif/A/*",
+        "/iiif/B/manifest.json",
+        "/iiif/C/*",
+        "/iiif/collection/views.json",
+    ]
+
+
+def test_collapse_paths_never_widens_past_items():
+    """Many retiled items don't evict the rest of the cache."""
+    paths = [f"/iiif/{n}/*" for n in range(20)] + [
+        "/iiif/collection/views.json",
+        "/iiif/collection/maps.json",
+    ]
+
+    collapsed = collapse_paths(paths)
+
+    assert "/iiif/*" not in collapsed
+    assert len(collapsed) == 21
+    assert "/iiif/collection/*" in collapsed
+
+
+def test_batch_paths_fits_limits():
+    paths = [f"/iiif/{n}/*" for n in range(20)] + ["/iiif/A/manifest.json", "/iiif/B/info.json"]
+
+    batches = batch_paths(paths, max_files=1, max_wildcards=15)
+
+    assert [len(batch) for batch in batches] == [15, 6, 1]
+    assert sorted(path for batch in batches for path in batch) == sorted(paths)
+
+
+def test_invalidations_submit(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        cloudfront = boto3.client("cloudfront")
+        distribution = cloudfront.create_distribution(
+            DistributionConfig={
+                "CallerReference": "test",
+                "Origins": {
+                    "Quantity": 1,
+                    "Items": [
+                        {
+                            "Id": "s3",
+                            "DomainName": "bucket.s3.amazonaws.com",
+                            "S3OriginConfig": {"OriginAccessIdentity": ""},
+                        }
+                    ],
+                },
+                "DefaultCacheBehavior": {
+                    "TargetOriginId": "s3",
+                    "ViewerProtocolPolicy": "allow-all",
+                    "MinTTL": 0,
+                },
+                "Comment": "",
+                "Enabled": True,
+            }
+        )["Distribution"]
+        invalidations = Invalidations(distribution["Id"])
+        invalidations.add("iiif/A/manifest.json")
+        invalidations.add_prefix("iiif/A/")
+        invalidations.add("iiif/B/manifest.json")
+
+        assert invalidations.submit() == ["/iiif/A/*", "/iiif/B/manifest.json"]
+        listed = cloudfront.list_invalidations(DistributionId=distribution["Id"])
+        assert listed["InvalidationList"]["Quantity"] == 1
+
+        # More item wildcards than CloudFront allows at once go in a second batch
+        waits = []
+        monkeypatch.setattr(
+            botocore.waiter.Waiter, "wait", lambda self, **kwargs: waits.append(kwargs)
+        )
+        for n in range(16):
+            invalidations.add_prefix(f"iiif/item{n}/")
+        paths = invalidations.submit()
+
+        assert len(paths) == 18 and "/iiif/*" not in paths
+        listed = cloudfront.list_invalidations(DistributionId=distribution["Id"])
+        assert listed["InvalidationList"]["Quantity"] == 3
+        assert len(waits) == 1
+
+
+def test_invalidations_dry_run_submits_nothing():
+    invalidations = Invalidations("DIST", dry_run=True)
+    invalidations.add("iiif/A/manifest.json")
+
+    assert invalidations.submit() == ["/iiif/A/manifest.json"]
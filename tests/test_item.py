@@ -1,9 +1,15 @@
 """Tests for the Item class."""
 
+import hashlib
+import json
+import os
+
 import pytest
+import responses
 from iiif_prezi3 import KeyValueString
+from PIL import Image
 
-from imaginerio_etl.entities.item import Item
+from imaginerio_etl.entities.item import Item, NotModified, TilingError, pyvips
 
 
 def test_item_initialization(sample_metadata_row, sample_vocabulary):
@@ -122,4 +128,139 @@ def test_dimension_conversion_with_string(sample_metadata_row, sample_vocabulary
     item = Item("Test0001", sample_metadata_row, sample_vocabulary)
     result = item._format_dimension("a string")
 
-    assert "a string" in result
\ No newline at end of file
+    assert "a string" in result
+
+
+def test_create_derivatives(sample_metadata_row, sample_vocabulary, tmp_path, monkeypatch):
+    """Test create_derivatives writes every level and records sizes in info.json"""
+    monkeypatch.chdir(tmp_path)
+    item = Item("TEST001", sample_metadata_row, sample_vocabulary)
+    os.makedirs("iiif/TEST001/full/max/0")
+    Image.new("RGB", (1003, 517), "red").save(item._local_img_path)
+    with open(item._local_info_path, "w") as f:
+        json.dump({"id": "TEST001", "sizes": []}, f)
+
+    sizes = item.create_derivatives([16, 8, 4, 2, 1])
+
+    assert sizes == [
+        {"width": 62, "height": 32},
+        {"width": 125, "height": 64},
+        {"width": 250, "height": 129},
+        {"width": 501, "height": 258},
+        {"width": 1003, "height": 517},
+    ]
+    for size in sizes[:-1]:
+        with Image.open(f"iiif/TEST001/full/{size['width']},{size['height']}/0/default.jpg") as im:
+            assert im.size == (size["width"], size["height"])
+    with open(item._local_info_path) as f:
+        assert json.load(f) == {"id": "TEST001", "sizes": sizes}
+
+
+@pytest.mark.skipif(pyvips is None, reason="pyvips not available")
+def test_tile_pyvips(sample_metadata_row, sample_vocabulary, tmp_path, monkeypatch):
+    """Test the in-process backend writes tiles, derivatives and sizes"""
+    monkeypatch.chdir(tmp_path)
+    item = Item("TEST001", sample_metadata_row, sample_vocabulary)
+    os.makedirs("iiif/TEST001/full/max/0")
+    Image.new("RGB", (1003, 517), "red").save(item._local_img_path)
+
+    sizes = item._tile_pyvips([16, 8, 4, 2, 1])
+
+    assert sizes[0] == {"width": 62, "height": 32}
+    assert sizes[-1] == {"width": 1003, "height": 517}
+    assert os.path.exists("iiif/TEST001/0,0,256,256/256,256/0/default.jpg")
+    with Image.open("iiif/TEST001/full/501,258/0/default.jpg") as im:
+        assert im.size == (501, 258)
+    with open(item._local_info_path) as f:
+        assert json.load(f)["sizes"] == sizes
+
+
+@pytest.mark.skipif(pyvips is None, reason="pyvips not available")
+def test_tile_pyvips_raises_tiling_error(sample_metadata_row, sample_vocabulary, tmp_path, monkeypatch):
+    """Test a corrupt source image raises TilingError"""
+    monkeypatch.chdir(tmp_path)
+    item = Item("TEST001", sample_metadata_row, sample_vocabulary)
+    os.makedirs("iiif/TEST001/full/max/0")
+    with open(item._local_img_path, "wb") as f:
+        f.write(b"not a jpeg")
+
+    with pytest.raises(TilingError):
+        item._tile_pyvips([2, 1])
+
+
+@responses.activate
+def test_download_image(sample_metadata_row, sample_vocabulary, tmp_path, monkeypatch):
+    """Test download_image streams the image to disk and returns its hash"""
+    monkeypatch.chdir(tmp_path)
+    item = Item("TEST001", sample_metadata_row, sample_vocabulary)
+    body = os.urandom(3000)
+    responses.get(item._jstor_img_path, body=body)
+
+    digest = item.download_image(chunk_size=1000)
+
+    assert digest == hashlib.sha256(body).hexdigest()
+    with open(item._local_img_path, "rb") as f:
+        assert f.read() == body
+    assert not os.path.exists(f"{item._local_img_path}.part")
+
+
+@responses.activate
+def test_download_image_resumes(sample_metadata_row, sample_vocabulary, tmp_path, monkeypatch):
+    """Test download_image resumes a partial download with a Range request"""
+    monkeypatch.chdir(tmp_path)
+    item = Item("TEST001", sample_metadata_row, sample_vocabulary)
+    body = os.urandom(3000)
+    os.makedirs(os.path.dirname(item._local_img_path))
+    with open(f"{item._local_img_path}.part", "wb") as f:
+        f.write(body[:1200])
+    with open(f"{item._local_img_path}.part.validator", "w") as f:
+        f.write('"v1"')
+    responses.get(
+        item._jstor_img_path,
+        body=body[1200:],
+        status=206,
+        match=[
+            responses.matchers.header_matcher({"Range": "bytes=1200-", "If-Range": '"v1"'})
+        ],
+    )
+
+    assert item.download_image() == hashlib.sha256(body).hexdigest()
+    with open(item._local_img_path, "rb") as f:
+        assert f.read() == body
+    assert not os.path.exists(f"{item._local_img_path}.part.validator")
+
+
+@responses.activate
+def test_download_image_restarts_changed_source(
+    sample_metadata_row, sample_vocabulary, tmp_path, monkeypatch
+):
+    """Test a .part of an older version of the source isn't resumed"""
+    monkeypatch.chdir(tmp_path)
+    item = Item("TEST001", sample_metadata_row, sample_vocabulary)
+    old, new = os.urandom(3000), os.urandom(2000)
+    os.makedirs(os.path.dirname(item._local_img_path))
+    with open(f"{item._local_img_path}.part", "wb") as f:
+        f.write(old[:1200])
+    with open(f"{item._local_img_path}.part.validator", "w") as f:
+        f.write('"v1"')
+    # If-Range doesn't match, the server sends the whole new version
+    responses.get(item._jstor_img_path, body=new, headers={"ETag": '"v2"'})
+
+    assert item.download_image() == hashlib.sha256(new).hexdigest()
+    with open(item._local_img_path, "rb") as f:
+        assert f.read() == new
+
+
+@responses.activate
+def test_download_image_not_modified(sample_metadata_row, sample_vocabulary, tmp_path, monkeypatch):
+    """Test download_image raises NotModified when the source hasn't changed"""
+    monkeypatch.chdir(tmp_path)
+    item = Item("TEST001", sample_metadata_row, sample_vocabulary)
+    responses.head(
+        item._jstor_img_path,
+        status=304,
+        match=[responses.matchers.header_matcher({"If-None-Match": '"v1"'})],
+    )
+
+    with pytest.raises(NotModified):
+        item.download_image(etag='"v1"')
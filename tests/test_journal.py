@@ -0,0 +1,58 @@
+"""Tests for the run checkpoint journal."""
+
+from imaginerio_etl.utils.journal import Journal
+
+
+def test_journal_tracks_progress(tmp_path):
+    path = str(tmp_path / "journal.db")
+    with Journal(path) as journal:
+        assert not journal.active()
+        journal.begin(["A", "B", "C"])
+        journal.complete("A", {"Views": '{"id": "a"}', "Maps": '{"id": "a"}'})
+        journal.complete("B", {"Views": '{"id": "b"}'})
+        journal.flushed(["Maps"])
+
+    with Journal(path) as journal:
+        assert journal.active()
+        assert journal.pending() == ["C"]
+        assert journal.collection_changes() == {"Views": ['{"id": "a"}', '{"id": "b"}']}
+
+        journal.begin(["A", "D"], resume=True)
+        assert sorted(journal.pending()) == ["A", "C", "D"]
+        assert "Views" in journal.collection_changes()
+
+        journal.finish()
+        assert not journal.active()
+        assert journal.collection_changes() == {}
+
+
+def test_journal_begin_discards_previous_run(tmp_path):
+    with Journal(str(tmp_path / "journal.db")) as journal:
+        journal.begin(["A"])
+        journal.complete("A", {"Views": "{}"})
+        journal.begin(["B"])
+
+        assert journal.pending() == ["B"]
+        assert journal.collection_changes() == {}
+
+
+def test_journal_records_removals(tmp_path):
+    with Journal(str(tmp_path / "journal.db")) as journal:
+        journal.begin(["A"])
+        journal.complete("A", {"Views": '{"id": "a"}'}, removals=["Maps"])
+        journal.complete("B", removals=["Views"])
+
+        assert journal.collection_changes() == {"Views": ['{"id": "a"}']}
+        assert journal.collection_removals() == {"Maps": ["A"], "Views": ["B"]}
+        journal.flushed(["Maps"])
+        assert journal.collection_removals() == {"Views": ["B"]}
+
+
+def test_journal_keeps_changes_of_pending_items(tmp_path):
+    path = str(tmp_path / "journal.db")
+    with Journal(path) as journal:
+        journal.begin(["A", "B", "C"], changes={"A": {"Collection": "Maps"}, "B": {"Title": None}})
+        journal.complete("B")
+
+    with Journal(path) as journal:
+        assert journal.changes() == {"A": {"Collection": "Maps"}}
@@ -0,0 +1,57 @@
+"""Tests for JPEG header parsing."""
+
+import io
+
+import pytest
+import responses
+from PIL import Image
+
+from imaginerio_etl.utils.jpeg import parse_jpeg_size, probe_image_size
+
+
+def make_jpeg(width, height, exif_padding=0):
+    """Encode a JPEG, optionally with a large APP1 segment before the frame."""
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), "red").save(
+        buffer, "JPEG", progressive=True, exif=b"Exif\x00\x00" + bytes(exif_padding)
+    )
+    return buffer.getvalue()
+
+
+def test_parse_jpeg_size():
+    """Dimensions are read from the frame header, progressive JPEGs included."""
+    assert parse_jpeg_size(make_jpeg(300, 200)) == (300, 200)
+
+
+def test_parse_jpeg_size_truncated():
+    """Data ending before the frame header returns None."""
+    data = make_jpeg(300, 200, exif_padding=10000)
+    assert parse_jpeg_size(data[:5000]) is None
+
+
+def test_parse_jpeg_size_not_a_jpeg():
+    buffer = io.BytesIO()
+    Image.new("RGB", (10, 10)).save(buffer, "PNG")
+    with pytest.raises(ValueError):
+        parse_jpeg_size(buffer.getvalue())
+
+
+@responses.activate
+def test_probe_image_size_grows_range():
+    """The range is widened until the frame header is within it."""
+    url = "https://example.com/image.jpg"
+    data = make_jpeg(640, 480, exif_padding=40000)
+    responses.get(
+        url,
+        body=data[:32768],
+        status=206,
+        match=[responses.matchers.header_matcher({"Range": "bytes=0-32767"})],
+    )
+    responses.get(
+        url,
+        body=data[:65536],
+        status=206,
+        match=[responses.matchers.header_matcher({"Range": "bytes=0-65535"})],
+    )
+
+    assert probe_image_size(url, first_bytes=32768) == (640, 480)
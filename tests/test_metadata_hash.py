@@ -0,0 +1,57 @@
+"""Tests for hash-based metadata change detection."""
+
+import numpy as np
+import pandas as pd
+
+from imaginerio_etl.utils.metadata_hash import (
+    diff_hashes,
+    hash_metadata,
+    load_hashes,
+    save_hashes,
+)
+
+
+def test_hash_metadata_normalizes_values():
+    """Formatting differences that Excel introduces don't count as changes."""
+    before = pd.DataFrame({"Date": [1920.0, np.nan], "Title": ["a ", None]}, index=["A", "B"])
+    after = pd.DataFrame({"Date": ["1920", ""], "Title": ["a", ""]}, index=["A", "B"])
+
+    assert (hash_metadata(before) == hash_metadata(after)).all().all()
+
+
+def test_diff_hashes_finds_added_changed_and_removed():
+    previous = pd.DataFrame(
+        {"Title": ["a", "b", "c"], "Collection": ["Views", "Maps", "Maps"]},
+        index=["A", "B", "C"],
+    )
+    current = pd.DataFrame(
+        {"Title": ["a", "b2", "d"], "Collection": ["Maps", "Maps", "Views"], "Date": "1920"},
+        index=["A", "B", "D"],
+    )
+    previous_hashes = hash_metadata(previous)
+
+    changes, removed = diff_hashes(
+        previous_hashes, previous["Collection"], hash_metadata(current)
+    )
+
+    assert changes == {
+        "A": {"Collection": "Views", "Date": None},
+        "B": {"Title": None, "Date": None},
+        "D": {"Status": None},
+    }
+    assert removed["Collection"].to_dict() == {"C": "Maps"}
+
+
+def test_hashes_round_trip(tmp_path):
+    path = str(tmp_path / "hashes.db")
+    data = pd.DataFrame(
+        {"Title": ["a", "b"], "Collection": ["Views", None]}, index=["A", "B"]
+    )
+    hashes = hash_metadata(data)
+
+    assert load_hashes(path) is None
+    save_hashes(hashes, data["Collection"], path)
+    loaded, collections = load_hashes(path)
+
+    assert (loaded == hashes).all().all()
+    assert collections.to_dict() == {"A": "Views", "B": None}
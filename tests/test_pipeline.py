@@ -0,0 +1,66 @@
+"""Tests for the staged pipeline."""
+
+import threading
+import time
+
+from imaginerio_etl.utils.pipeline import Stage, run_pipeline
+
+
+def test_run_pipeline_passes_items_through_every_stage():
+    stages = [
+        Stage("double", lambda n: n * 2, 2),
+        Stage("increment", lambda n: n + 1, 3),
+    ]
+    results = list(run_pipeline(range(10), stages))
+
+    assert sorted(item for item, _ in results) == [n * 2 + 1 for n in range(10)]
+    assert all(error is None for _, error in results)
+
+
+def test_run_pipeline_errors_skip_later_stages():
+    calls = []
+
+    def fail_on_three(n):
+        if n == 3:
+            raise ValueError("three")
+        return n
+
+    stages = [Stage("check", fail_on_three, 1), Stage("record", calls.append, 1)]
+    results = {item: error for item, error in run_pipeline(range(5), stages)}
+
+    assert isinstance(results[3], ValueError)
+    assert sorted(calls) == [0, 1, 2, 4]
+
+
+def test_run_pipeline_applies_backpressure():
+    """A slow last stage bounds how many items earlier stages take in."""
+    started = []
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def start(n):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        return n
+
+    def slow_finish(n):
+        nonlocal in_flight
+        time.sleep(0.01)
+        with lock:
+            in_flight -= 1
+        return n
+
+    stages = [Stage("start", start, 4), Stage("finish", slow_finish, 1)]
+    assert len(list(run_pipeline(range(30), stages, queue_size=1))) == 30
+    # workers of both stages plus the queues after the first stage
+    assert max_in_flight <= 4 + 1 + 1 + 1
+
+
+def test_run_pipeline_stops_when_closed():
+    results = run_pipeline(iter(range(1000)), [Stage("identity", lambda n: n, 2)])
+    next(results)
+    results.close()
+    assert not any(t.name.startswith("pipeline-") for t in threading.enumerate())
@@ -0,0 +1,112 @@
+"""Tests for the S3 object index."""
+
+import hashlib
+import os
+
+import pandas as pd
+
+from imaginerio_etl.entities.collection import LazyCollections
+from imaginerio_etl.scripts import iiif
+from imaginerio_etl.utils import helpers
+from imaginerio_etl.utils.helpers import create_collection
+from imaginerio_etl.utils.s3index import S3Index
+
+
+def put(s3, key, body=b"data"):
+    s3.put_object(Bucket=helpers.BUCKET_NAME, Key=key, Body=body)
+
+
+def test_refresh_answers_queries_locally(s3, tmp_path, monkeypatch):
+    put(s3, "iiif/A/info.json", b"{}")
+    put(s3, "iiif/A/full/max/0/default.jpg", b"jpeg")
+    index = S3Index(str(tmp_path / "index.db"))
+
+    assert index.refresh("iiif/") == 2
+    monkeypatch.setattr(helpers, "s3_client", None)  # no more requests
+    assert index.exists("iiif/A/info.json")
+    assert not index.exists("iiif/B/info.json")
+    assert index.size("iiif/A/full/max/0/default.jpg") == 4
+    assert index.etag("iiif/A/info.json") == hashlib.md5(b"{}").hexdigest()
+    assert index.is_fresh("iiif/A/info.json")
+    assert not index.is_fresh("other/key")
+
+
+def test_refresh_by_prefix_replaces_only_that_prefix(s3, tmp_path):
+    put(s3, "iiif/A/info.json")
+    put(s3, "iiif/AB/info.json")
+    index = S3Index(str(tmp_path / "index.db"))
+    index.refresh("iiif/")
+
+    s3.delete_object(Bucket=helpers.BUCKET_NAME, Key="iiif/A/info.json")
+    put(s3, "iiif/A/manifest.json")
+    index.refresh("iiif/A/")
+
+    assert not index.exists("iiif/A/info.json")
+    assert index.exists("iiif/A/manifest.json")
+    assert index.exists("iiif/AB/info.json")
+    assert len(index) == 2
+
+
+def test_file_exists_uses_fresh_index_or_head(s3, tmp_path, monkeypatch):
+    put(s3, "iiif/A/manifest.json")
+    index = S3Index(str(tmp_path / "index.db"))
+
+    assert helpers.file_exists("A", "manifest", index)
+    assert not helpers.file_exists("A", "info", index)
+    assert index.listed_at("iiif/A/manifest.json") is None  # no listing per item
+
+    index.refresh("iiif/")
+    monkeypatch.setattr(helpers, "get_etag", None)
+    assert helpers.file_exists("A", "manifest", index)
+
+
+def test_update_heads_unhashed_manifests_and_records_uploads(s3, tmp_path, monkeypatch):
+    """Manifests without a stored hash are read by key, never by listing iiif/."""
+    put(s3, "iiif/A/manifest.json")
+    put(s3, "iiif/A/info.json")
+    index = S3Index(str(tmp_path / "index.db"))
+    monkeypatch.setattr(iiif, "S3Index", lambda: index)
+    monkeypatch.setattr(S3Index, "refresh", None)
+    monkeypatch.setattr(index, "close", lambda: None)
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("iiif/B")
+    with open("iiif/B/info.json", "w") as f:
+        f.write("{}")
+    objects = helpers.tree_objects("iiif/B")
+    monkeypatch.setattr(
+        iiif,
+        "_process_pipeline",
+        lambda rows, *args, **kwargs: iter(
+            [("B", rows.loc["B"], {"sizes": [], "upload": {"objects": objects}}, None)]
+        ),
+    )
+    monkeypatch.setattr(iiif, "get_vocabulary", lambda path: {})
+    monkeypatch.setattr(
+        iiif,
+        "get_collections",
+        lambda metadata, extra_labels=(): LazyCollections({}, create_collection),
+    )
+    monkeypatch.setattr(iiif, "prefetch_sizes", lambda ids: {})
+    metadata = pd.DataFrame({"Title": ["a", "b"], "Collection": [None, None]}, index=["A", "B"])
+
+    iiif.update(metadata)
+
+    assert index.listed_at("iiif/") is None
+    assert index.is_fresh("iiif/A/manifest.json") and index.exists("iiif/A/manifest.json")
+    assert index.is_fresh("iiif/B/manifest.json") and not index.exists("iiif/B/manifest.json")
+    assert not index.exists("iiif/A/info.json")
+    assert index.etag("iiif/B/info.json") == hashlib.md5(b"{}").hexdigest()
+
+
+def test_publish_manifest_uses_fresh_index(s3, tmp_path, monkeypatch):
+    """ETags come from the index, and uploads are recorded in it."""
+    manifest_json = '{"id": "m"}'
+    put(s3, "iiif/A/manifest.json", manifest_json.encode())
+    index = S3Index(str(tmp_path / "index.db"))
+    index.refresh("iiif/")
+    monkeypatch.setattr(iiif, "get_etag", None)
+    monkeypatch.setattr(iiif, "upload_object_to_s3", lambda obj, name, key: True)
+
+    assert iiif.publish_manifest("A", manifest_json, index=index)[0] is False
+    assert iiif.publish_manifest("A", '{"id": "n"}', index=index)[0] is True
+    assert index.etag("iiif/A/manifest.json") == hashlib.md5(b'{"id": "n"}').hexdigest()
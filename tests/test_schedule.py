@@ -0,0 +1,59 @@
+"""Tests for deadline-aware scheduling."""
+
+import time
+
+import pytest
+
+from imaginerio_etl.utils import schedule
+
+
+def test_estimate_costs_learns_from_past_timings():
+    timings = [(100 * 1024**2, 100.0), (10 * 1024**2, 10.0), (50 * 1024**2, 50.0)]
+    states = {
+        "MANIFEST": {"sizes": [{}]},
+        "RETILE": {"sizes": [{}], "tile_seconds": 30.0},
+        "SIZED": {"source_bytes": 20 * 1024**2},
+        "UNKNOWN": {},
+    }
+    flags = {"MANIFEST": False, "RETILE": True, "SIZED": True, "UNKNOWN": True}
+
+    costs = schedule.estimate_costs(states, flags, timings)
+
+    extra = schedule.MANIFEST_SECONDS
+    assert costs["MANIFEST"] == extra
+    assert costs["RETILE"] == 30.0 + extra
+    assert costs["SIZED"] == pytest.approx(20.0 + extra)
+    assert costs["UNKNOWN"] == pytest.approx(50.0 + extra)  # median known size
+
+
+def test_order_by_cost_puts_manifests_first_and_large_scans_last():
+    flags = {"A": True, "B": False, "C": True, "D": False}
+    costs = {"A": 500, "B": 1, "C": 20, "D": 1}
+
+    assert schedule.order_by_cost(flags, flags, costs) == ["B", "D", "C", "A"]
+
+
+def test_within_deadline_defers_what_does_not_fit():
+    costs = {"A": 1, "B": 10, "C": 1000, "D": 2000}
+    deferred = []
+
+    ids = list(schedule.within_deadline("ABCD", costs, time.monotonic() + 100, deferred))
+
+    assert ids == ["A", "B"]
+    assert deferred == ["C", "D"]
+
+
+def test_within_deadline_waits_for_items_in_flight():
+    """Items still being processed delay the next one, shared by the workers."""
+    costs = {"A": 60, "B": 60, "C": 80}
+    deferred = []
+    in_flight = schedule.InFlight(costs, workers=2)
+
+    ids = schedule.within_deadline("ABC", costs, time.monotonic() + 100, deferred, in_flight)
+
+    assert next(ids) == "A"
+    assert in_flight.seconds == 30
+    in_flight.finish("A")
+    assert next(ids) == "B"
+    assert list(ids) == []
+    assert deferred == ["C"]
@@ -0,0 +1,153 @@
+"""Tests for sharded runs and their finalize step."""
+
+import json
+import multiprocessing
+import os
+
+import pandas as pd
+import pytest
+
+from imaginerio_etl.entities.collection import LazyCollections
+from imaginerio_etl.entities.item import Item
+from imaginerio_etl.scripts import iiif
+from imaginerio_etl.scripts.finalize import finalize
+from imaginerio_etl.utils.helpers import create_collection
+from imaginerio_etl.utils.invalidation import Invalidations
+from imaginerio_etl.utils.shard import (
+    ShardArtifact,
+    load_shards,
+    merge_summaries,
+    parse_shard,
+    select_shard,
+    shard_of,
+)
+from imaginerio_etl.utils.state import StateStore
+
+
+SIZES = [{"width": 100, "height": 50}, {"width": 1600, "height": 800}]
+COLLECTION_KEY = "iiif/collection/views.json"
+
+
+@pytest.mark.parametrize("text", ["0/2", "3/2", "1", "a/b", "1/0"])
+def test_parse_shard_rejects_invalid(text):
+    with pytest.raises(ValueError):
+        parse_shard(text)
+
+
+def test_shards_partition_items_deterministically():
+    """Every item lands in exactly one shard, whatever the row order."""
+    metadata = pd.DataFrame({"Title": "x"}, index=[f"ITEM{n}" for n in range(50)])
+    shards = [select_shard(metadata, index, 4) for index in range(1, 5)]
+
+    assert sorted(id for shard in shards for id in shard.index) == sorted(metadata.index)
+    assert all(len(shard) for shard in shards)
+    reordered = select_shard(metadata.iloc[::-1], 2, 4)
+    assert sorted(reordered.index) == sorted(shards[1].index)
+    assert shard_of("ITEM0", 4) == shard_of("ITEM0", 4)
+
+
+def test_load_shards_requires_every_shard(tmp_path):
+    ShardArtifact(1, 2, tmp_path).save()
+    with pytest.raises(ValueError, match="Missing"):
+        load_shards(tmp_path)
+    ShardArtifact(2, 2, tmp_path).save()
+    ShardArtifact(1, 3, tmp_path).save()
+    with pytest.raises(ValueError, match="different counts"):
+        load_shards(tmp_path)
+
+
+def test_merge_summaries():
+    merged = merge_summaries(
+        [
+            {"n_items": 2, "errors": ["A"], "elapsed": 10.0, "max_peak_rss": 5},
+            {"n_items": 3, "errors": [], "elapsed": 30.0, "max_peak_rss": 2},
+        ]
+    )
+    assert merged == {"n_items": 5, "errors": ["A"], "elapsed": 30.0, "max_peak_rss": 5}
+
+
+@pytest.fixture
+def bucket(monkeypatch, sample_vocabulary, tmp_path):
+    """Stand in for S3 with a directory, logging every PUT."""
+    root = tmp_path / "bucket"
+
+    def upload(obj, name, key):
+        path = root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(obj, encoding="utf-8")
+        with open(root / "puts.log", "a", encoding="utf-8") as f:
+            f.write(key + "\n")
+        return True
+
+    def get_sizes(self):
+        if self._id == "BROKEN":
+            raise ValueError("broken item")
+        return SIZES
+
+    def load_collections(labels):
+        path = root / COLLECTION_KEY
+        source = json.loads(path.read_text()) if path.exists() else None
+        return LazyCollections({"Views": source}, create_collection)
+
+    monkeypatch.setattr(Item, "get_sizes", get_sizes)
+    monkeypatch.setattr(
+        iiif, "prefetch_sizes", lambda ids: {id: SIZES for id in ids if id != "BROKEN"}
+    )
+    monkeypatch.setattr(iiif, "get_vocabulary", lambda path: sample_vocabulary)
+    monkeypatch.setattr(iiif, "get_collections", None)  # shards must not load them
+    monkeypatch.setattr(iiif, "upload_object_to_s3", upload)
+    monkeypatch.setattr(iiif, "get_etag", lambda key: None)
+    monkeypatch.setattr(iiif.S3Index, "head_many", lambda self, keys: 0)
+    monkeypatch.setattr("imaginerio_etl.scripts.finalize.load_collections", load_collections)
+    return root
+
+
+def _run_shard(metadata, index, count, workdir, artifacts):
+    os.makedirs(workdir)
+    os.chdir(workdir)  # every shard runs on its own machine
+    artifact = ShardArtifact(index, count, artifacts)
+    artifact.summary = iiif.update(
+        select_shard(metadata, index, count),
+        invalidations=Invalidations(dry_run=True),
+        artifact=artifact,
+        flush_every=2,
+    )
+    artifact.save()
+
+
+def test_sharded_run_publishes_collections_once(sample_metadata_row, bucket, tmp_path):
+    """Shards run in separate processes, finalize merges them into one upload."""
+    rows = {f"ITEM{n}": dict(sample_metadata_row, Collection="Views") for n in range(9)}
+    rows["BROKEN"] = dict(sample_metadata_row, Collection="Views")
+    metadata = pd.DataFrame.from_dict(rows, orient="index")
+    artifacts = tmp_path / "shards"
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(
+            target=_run_shard,
+            args=(metadata, index, 3, tmp_path / f"shard{index}", artifacts),
+        )
+        for index in range(1, 4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0, 0, 0]
+    assert COLLECTION_KEY not in (bucket / "puts.log").read_text()
+
+    invalidations = Invalidations(dry_run=True)
+    with StateStore(str(tmp_path / "state.db")) as store:
+        summary = finalize(artifacts, 3, invalidations, store)
+        assert len(store) == 9
+
+    puts = (bucket / "puts.log").read_text().split()
+    assert puts.count(COLLECTION_KEY) == 1
+    collection = (bucket / COLLECTION_KEY).read_text()
+    assert all(f"/ITEM{n}/" in collection for n in range(9))
+    assert summary["n_items"] == 10
+    assert summary["n_published"] == 9
+    assert summary["errors"] == ["BROKEN"]
+    assert "/" + COLLECTION_KEY in invalidations.touched()
+    assert "/iiif/ITEM0/manifest.json" in invalidations.touched()
+    assert not os.listdir(artifacts)
@@ -0,0 +1,73 @@
+"""Tests for the item state store."""
+
+import json
+
+import pytest
+from moto import mock_aws
+
+from imaginerio_etl.scripts import state as state_script
+from imaginerio_etl.utils import helpers
+from imaginerio_etl.utils.state import StateStore
+
+
+SIZES = [{"width": 100, "height": 50}, {"width": 1600, "height": 800}]
+
+
+@pytest.fixture
+def store(tmp_path):
+    with StateStore(str(tmp_path / "state.db")) as store:
+        yield store
+
+
+def test_update_and_get(store):
+    """Updates merge into the stored row and stamp processed_at."""
+    store.update("TEST001", sizes=SIZES, source_hash="abc")
+    store.update("TEST001", manifest_hash="def")
+
+    state = store.get("TEST001")
+    assert state["sizes"] == SIZES
+    assert state["source_hash"] == "abc"
+    assert state["manifest_hash"] == "def"
+    assert state["processed_at"]
+    assert store.get_sizes("TEST001") == SIZES
+    assert store.get("MISSING") is None
+    assert len(store) == 1
+
+
+def test_update_rejects_unknown_fields(store):
+    with pytest.raises(ValueError):
+        store.update("TEST001", color="red")
+
+
+def test_store_persists(tmp_path):
+    path = str(tmp_path / "state.db")
+    with StateStore(path) as store:
+        store.update("TEST001", sizes=SIZES)
+    with StateStore(path) as store:
+        assert store.get_sizes("TEST001") == SIZES
+
+
+def test_rebuild_from_bucket(store, monkeypatch):
+    """Sizes are read from published info.json files, source hashes are kept."""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = helpers.create_s3_client()
+        monkeypatch.setattr(helpers, "s3_client", client)
+        client.create_bucket(Bucket="bucket")
+        client.put_object(
+            Bucket="bucket", Key="iiif/TEST001/info.json", Body=json.dumps({"sizes": SIZES})
+        )
+        client.put_object(Bucket="bucket", Key="iiif/TEST001/manifest.json", Body="{}")
+        client.put_object(Bucket="bucket", Key="iiif/NOINFO/full/max/0/default.jpg", Body="")
+        client.put_object(Bucket="bucket", Key="iiif/collection/views.json", Body="{}")
+        store.update("TEST001", source_hash="abc")
+
+        assert state_script.rebuild(store, "bucket", threads=2) == 1
+
+    state = store.get("TEST001")
+    assert state["sizes"] == SIZES
+    assert state["source_hash"] == "abc"
+    assert state["manifest_hash"]
+    assert store.get("NOINFO") is None
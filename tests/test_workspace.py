@@ -0,0 +1,68 @@
+"""Tests for the disk-budgeted workspace."""
+
+import os
+import threading
+
+from imaginerio_etl.utils.pipeline import Cancelled
+from imaginerio_etl.utils.workspace import EXPANSION, Workspace
+
+
+def make_tree(workspace, id, size):
+    path = os.path.join(workspace.path(id), "full", "max", "0")
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "default.jpg"), "wb") as f:
+        f.write(bytes(size))
+
+
+def test_reserve_waits_for_release(tmp_path):
+    """Tiling pauses while the budget is used up and resumes once space is freed."""
+    workspace = Workspace(str(tmp_path), budget=1000 * EXPANSION)
+    make_tree(workspace, "A", 800)
+    make_tree(workspace, "B", 800)
+    workspace.reserve("A")
+
+    reserved = threading.Event()
+    thread = threading.Thread(target=lambda: workspace.reserve("B") or reserved.set())
+    thread.start()
+    assert not reserved.wait(0.2)
+
+    workspace.release("A")
+    assert reserved.wait(1)
+    thread.join()
+    assert not os.path.exists(workspace.path("A"))
+    assert workspace.used == 800 * EXPANSION
+
+
+def test_oversized_item_fits_when_workspace_is_empty(tmp_path):
+    workspace = Workspace(str(tmp_path), budget=10)
+    make_tree(workspace, "A", 800)
+    workspace.reserve("A")
+    workspace.measure("A")
+
+    assert workspace.used == 800
+
+
+def test_reserve_gives_up_when_cancelled(tmp_path):
+    """A wait for space ends when the pipeline is cancelled, instead of hanging."""
+    workspace = Workspace(str(tmp_path), budget=1000 * EXPANSION)
+    make_tree(workspace, "A", 800)
+    make_tree(workspace, "B", 800)
+    workspace.reserve("A")
+    cancelled = threading.Event()
+    errors = []
+
+    def reserve():
+        try:
+            workspace.reserve("B", cancelled)
+        except Cancelled as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=reserve)
+    thread.start()
+
+    cancelled.set()
+    thread.join(1)
+
+    assert not thread.is_alive()
+    assert len(errors) == 1
+    assert workspace.used == 800 * EXPANSION